@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Myth-Backlog.py
+    Copyright (C) 2025  Scott P. Morton PhD
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+#---------------------------
+#   Name: Myth-Backlog.py
+#   Python Script
+#   Author: Scott Morton PhD
+#
+#   For use with Myth 34+
+
+
+#   Queues a job for every recording matching a set of filters.
+#---------------------------
+
+# Filters are 'column op value', for example
+#    Myth-Backlog.py --job userjob1 'title=The Three Stooges' 'season=0'
+# queues user job 1 (Myth-Rec-to-Vid-v3 in most setups) for every recording
+# of that show without a season. The filters are turned into one query on
+# the recorded table that only reads the keys, and the jobs are written
+# with one insert per ROWBATCH rows, so no Recorded objects are built.
+
+
+__title__  = "Myth-Backlog"
+__author__ = "Scott P. Morton PhD"
+__version__= "v1.0.0"
+
+from MythTV import MythDB, Job
+from optparse import OptionParser
+
+import sys, re
+from datetime import datetime, timezone
+
+# Global Constants
+
+# Operators accepted in a filter and their SQL, '~' is a LIKE pattern
+OPERATORS = {'=':'=', '!=':'<>', '<':'<', '<=':'<=', '>':'>', '>=':'>=',
+             '~':'LIKE', '!~':'NOT LIKE'}
+FILTER = re.compile(r'^\s*(\w+)\s*(!=|<=|>=|!~|=|<|>|~)\s*(.*?)\s*$')
+
+# Names accepted by --job
+JOBTYPES = {'transcode':Job.TRANSCODE, 'commflag':Job.COMMFLAG,
+            'metadata':Job.METADATA, 'preview':Job.PREVIEW,
+            'userjob1':Job.USERJOB1, 'userjob2':Job.USERJOB2,
+            'userjob3':Job.USERJOB3, 'userjob4':Job.USERJOB4}
+
+# A job in one of these states still counts as queued for the recording
+ACTIVE = (Job.QUEUED, Job.PENDING, Job.STARTING, Job.RUNNING, Job.STOPPING,
+          Job.PAUSED, Job.RETRY)
+
+# jobqueue rows written per INSERT
+ROWBATCH = 1000
+
+def compile_filters(filters, columns):
+    # Turn the filters into one WHERE clause and its arguments. Only columns
+    # of the recorded table are accepted, 'NULL' compares as IS [NOT] NULL.
+    where = []
+    args = []
+    for text in filters:
+        match = FILTER.match(text)
+        if not match:
+            raise ValueError('Filter not understood: {}'.format(text))
+        column, op, value = match.groups()
+        column = column.lower()
+        if column not in columns:
+            raise ValueError('No column {} in recorded'.format(column))
+        if value.upper() == 'NULL' and op in ('=', '!='):
+            where.append('recorded.{} IS {}NULL'.format(column,
+                                                        'NOT ' if op == '!=' else ''))
+            continue
+        where.append('recorded.{} {} %s'.format(column, OPERATORS[op]))
+        args.append(value)
+    if not where:
+        raise ValueError('At least one filter is needed')
+    return ' AND '.join(where), args
+
+def recorded_columns(db):
+    # the column names of recorded, without reading a row
+    with db as cursor:
+        cursor.execute('SELECT * FROM recorded LIMIT 0')
+        return set(desc[0].lower() for desc in cursor.description)
+
+def find_keys(db, where, args, jobtype, requeue=False, listing=False):
+    # The keys of the matching recordings, leaving out those that already
+    # have a job of this type waiting or running unless requeue is set
+    fields = 'recorded.chanid, recorded.starttime'
+    if listing:
+        fields += ', recorded.title, recorded.subtitle'
+    if not requeue:
+        where += """ AND NOT EXISTS (SELECT 1 FROM jobqueue
+                        WHERE jobqueue.chanid=recorded.chanid
+                          AND jobqueue.starttime=recorded.starttime
+                          AND jobqueue.type=%s
+                          AND jobqueue.status IN ({}))""".format(
+                                ','.join(['%s']*len(ACTIVE)))
+        args = args + [jobtype] + list(ACTIVE)
+    with db as cursor:
+        cursor.execute('SELECT {} FROM recorded WHERE {} ORDER BY recorded.starttime'
+                       .format(fields, where), args)
+        return cursor.fetchall()
+
+def queue_jobs(db, keys, jobtype, hostname='', jobargs='', comment=''):
+    # Write a QUEUED jobqueue row for every key, ROWBATCH rows per statement
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    rows = [(chanid, starttime, now, jobtype, Job.RUN, Job.NO_FLAGS,
+             Job.QUEUED, now, hostname, jobargs, comment, now)
+            for chanid, starttime in keys]
+    values = '(' + ','.join(['%s']*12) + ')'
+    with db as cursor:
+        for first in range(0, len(rows), ROWBATCH):
+            chunk = rows[first:first+ROWBATCH]
+            cursor.execute("""INSERT INTO jobqueue (chanid, starttime, inserttime,
+                                  type, cmds, flags, status, statustime, hostname,
+                                  args, comment, schedruntime)
+                              VALUES """ + ','.join([values]*len(chunk)),
+                           [field for row in chunk for field in row])
+    return len(rows)
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] filter [filter ...]\n\n"+\
+                    "A filter is 'column op value' on the recorded table, op is one of "+\
+                    "= != < <= > >= or ~ and !~ for LIKE patterns. Filters combine with AND.")
+    parser.add_option("--job", action="store", type="string", default="userjob1", dest="job",
+            help="Job to queue, one of " + ', '.join(sorted(JOBTYPES)) +\
+                 " or a job type number, default userjob1.")
+    parser.add_option("--host", action="store", type="string", default="", dest="host",
+            help="Backend that should run the jobs, default any.")
+    parser.add_option("--args", action="store", type="string", default="", dest="args",
+            help="Arguments stored with each job.")
+    parser.add_option("--requeue", action="store_true", default=False, dest="requeue",
+            help="Also queue recordings that already have this job waiting or running.")
+    parser.add_option("--dry-run", action="store_true", default=False, dest="dryrun",
+            help="List the matching recordings without queueing anything.")
+
+    opts, args = parser.parse_args()
+    if not args:
+        parser.error('At least one filter is needed')
+    if opts.job.lower() in JOBTYPES:
+        jobtype = JOBTYPES[opts.job.lower()]
+    elif opts.job.isdigit():
+        jobtype = int(opts.job)
+    else:
+        parser.error('Unknown job: ' + opts.job)
+
+    db = MythDB()
+    try:
+        where, whereargs = compile_filters(args, recorded_columns(db))
+    except ValueError as e:
+        parser.error(str(e))
+
+    keys = find_keys(db, where, whereargs, jobtype, opts.requeue, opts.dryrun)
+    if opts.dryrun:
+        for chanid, starttime, title, subtitle in keys:
+            print('{} {:%Y-%m-%d %H:%M:%S} {} - {}'.format(chanid, starttime,
+                                                          title, subtitle or ''))
+        print('{} recordings would be queued'.format(len(keys)))
+        sys.exit(0)
+
+    count = queue_jobs(db, keys, jobtype, opts.host, opts.args,
+                       'Queued by ' + __title__)
+    print('{} jobs queued'.format(count))
+    sys.exit(0)
+
+if __name__ == "__main__":
+    main()
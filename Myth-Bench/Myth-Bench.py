@@ -0,0 +1,818 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+    Myth-Bench.py
+    Copyright (C) 2025  Scott P. Morton PhD
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+#---------------------------
+#   Name: Myth-Bench.py
+#   Python Script
+#   Author: Scott Morton PhD
+#
+#   Needs no MythTV installation.
+
+
+#   Benchmarks the scripts of this collection without a live backend.
+#---------------------------
+
+# The scripts run against fake/MythTV.py, a stand-in for the bindings on
+# an SQLite database, and a myth:// style file server this script runs on
+# localhost. A work directory gets a multi-GB sparse recording with its seek
+# table and markup, a recordings table for Myth-Backlog and a video library
+# with a file per entry. Every phase runs in its own process, --repeat
+# times, against a fresh copy of the database, and reports its time,
+# throughput, database queries, backend round trips and peak RSS.
+#
+# --save keeps the results, --baseline compares a run with saved results
+# and exits 1 when a phase got slower or bigger than --tolerance allows.
+#
+# Myth-Vid-Tool.py is Python 2, its phases are skipped when --python2 does
+# not name a working interpreter.
+
+
+__title__  = "Myth-Bench"
+__author__ = "Scott P. Morton PhD"
+__version__= "v1.0.0"
+
+from optparse import OptionParser, OptionGroup, SUPPRESS_HELP, Values
+
+import sys, os, json, time, struct, shutil, random, sqlite3, tempfile
+import subprocess, socketserver, threading, statistics, importlib.util
+from datetime import datetime, timedelta
+
+# Global Constants
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FAKEDIR = os.path.join(HERE, 'fake')
+SCRIPTS = {'v3':os.path.join(HERE, '..', 'Myth-Rec-to-Vid', 'Myth-Rec-to-Vid-v3.py'),
+           'vidtool':os.path.join(HERE, '..', 'Myth-Vid-Tool', 'Myth-Vid-Tool.py'),
+           'backlog':os.path.join(HERE, '..', 'Myth-Backlog', 'Myth-Backlog.py')}
+
+# This machine and another backend, for transfers that have to use myth://,
+# a backend that does not answer and one without a Videos group
+HOST = 'benchhost'
+REMOTE = 'remotehost'
+DOWN = 'downhost'
+NOGROUP = 'nogrouphost'
+
+# The recording the copy phases migrate
+RECORDING = (9999, '2020-01-01 00:00:00')
+
+# Bytes hashed at each end of the file, see FileHash() in libmythbase
+HASHWINDOW = 2**16
+
+# Block size of the file server
+BLOCK = 2**20
+
+# The tables the scripts use, with the columns they read
+SCHEMA = """
+CREATE TABLE recorded (chanid INTEGER, starttime DATETIME, endtime DATETIME,
+    title TEXT, subtitle TEXT, description TEXT, season INTEGER, episode INTEGER,
+    category TEXT, hostname TEXT, storagegroup TEXT, recgroup TEXT, basename TEXT,
+    filesize INTEGER, programid TEXT, inetref TEXT, PRIMARY KEY (chanid, starttime));
+CREATE TABLE recordedseek (chanid INTEGER, starttime DATETIME, mark INTEGER,
+    offset INTEGER, type INTEGER);
+CREATE INDEX recordedseek_key ON recordedseek (chanid, starttime);
+CREATE TABLE recordedmarkup (chanid INTEGER, starttime DATETIME, mark INTEGER,
+    type INTEGER, data INTEGER);
+CREATE INDEX recordedmarkup_key ON recordedmarkup (chanid, starttime);
+CREATE TABLE filemarkup (filename TEXT, mark INTEGER, offset INTEGER, type INTEGER);
+CREATE TABLE videometadata (intid INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT,
+    subtitle TEXT, tagline TEXT, director TEXT, plot TEXT, rating TEXT,
+    inetref TEXT, year INTEGER, length INTEGER, season INTEGER, episode INTEGER,
+    filename TEXT, hash TEXT, coverfile TEXT, category TEXT, trailer TEXT,
+    host TEXT, screenshot TEXT, banner TEXT, fanart TEXT, insertdate DATETIME,
+    filesize INTEGER);
+CREATE INDEX videometadata_filename ON videometadata (filename);
+CREATE TABLE videometadatacast (idvideo INTEGER, idcast INTEGER);
+CREATE TABLE videometadatagenre (idvideo INTEGER, idgenre INTEGER);
+CREATE TABLE videometadatacountry (idvideo INTEGER, idcountry INTEGER);
+CREATE TABLE videotypes (extension TEXT, playcommand TEXT, f_ignore INTEGER);
+CREATE TABLE jobqueue (id INTEGER PRIMARY KEY AUTOINCREMENT, chanid INTEGER,
+    starttime DATETIME, inserttime DATETIME, type INTEGER, cmds INTEGER,
+    flags INTEGER, status INTEGER, statustime DATETIME, hostname TEXT, args TEXT,
+    comment TEXT, schedruntime DATETIME);
+CREATE INDEX jobqueue_key ON jobqueue (chanid, starttime);
+CREATE TABLE settings (value TEXT, data TEXT, hostname TEXT);
+"""
+
+class BenchError(Exception):
+    pass
+
+def myth_hash(path):
+    # MythBE.getHash() of a local file: size plus the little endian 64 bit
+    # words of the first and last 64 KiB, in unpadded hex
+    size = os.path.getsize(path)
+    if not size:
+        return 'NULL'
+    total = size
+    with open(path, 'rb') as fp:
+        for offset in (0, max(size - HASHWINDOW, 0)):
+            fp.seek(offset)
+            window = fp.read(HASHWINDOW)
+            words = len(window)//8
+            total += sum(struct.unpack('<{}Q'.format(words), window[:words*8]))
+    return '{:x}'.format(total & 0xFFFFFFFFFFFFFFFF)
+
+#---------------------------
+#   Setup
+#---------------------------
+
+def workpaths(work):
+    return {'config':os.path.join(work, 'bench.json'),
+            'template':os.path.join(work, 'template.sqlite'),
+            'db':os.path.join(work, 'mythconverg.sqlite'),
+            'home':os.path.join(work, 'home'),
+            'logs':os.path.join(work, 'logs'),
+            'sg':os.path.join(work, 'sg')}
+
+def storage_groups(work):
+    # [group, host, directory], the recording is reachable from both hosts
+    sg = workpaths(work)['sg']
+    groups = [['Default', HOST, os.path.join(sg, 'Default')],
+              ['Default', REMOTE, os.path.join(sg, 'Default')],
+              ['Videos', HOST, os.path.join(sg, 'Videos')],
+              ['Videos', REMOTE, os.path.join(sg, 'Videos-remote')],
+              ['Videos', DOWN, os.path.join(sg, 'Videos-down')]]
+    for group in ('Coverart', 'Fanart', 'Banners', 'Screenshots', 'Trailers'):
+        groups.append([group, HOST, os.path.join(sg, group)])
+    return groups
+
+def make_recording(path, size, seed):
+    # A sparse file with random data at the start, middle and end, so the
+    # hash covers real bytes and the copy reads the holes as zeros
+    rnd = random.Random(seed)
+    with open(path, 'wb') as fp:
+        fp.truncate(size)
+        for offset in (0, size//2, size - BLOCK):
+            fp.seek(offset)
+            fp.write(rnd.randbytes(BLOCK))
+
+def make_database(path, opts, recsize, seed):
+    # Returns the number of videos under Movies/ for the update phase
+    rnd = random.Random(seed)
+    con = sqlite3.connect(path)
+    con.executescript(SCHEMA)
+    base = datetime(2015, 1, 1)
+
+    recorded = [(1000 + i % 50, base + timedelta(minutes=30*i),
+                 base + timedelta(minutes=30*i + 29), 'Show {}'.format(i % 500),
+                 'Episode {}'.format(i), '', i % 10, i % 24, 'Series', HOST,
+                 'Default', 'Default', '{}_{}.ts'.format(1000 + i % 50, i),
+                 2**30, 'EP{:08d}'.format(i), '')
+                for i in range(opts.recordings)]
+    start = datetime.strptime(RECORDING[1], '%Y-%m-%d %H:%M:%S')
+    recorded.append((RECORDING[0], start, start + timedelta(hours=1),
+                     'Bench Show', 'Bench Episode', 'A recording to copy', 1, 2,
+                     'Series', HOST, 'Default', 'Default',
+                     '{}_{:%Y%m%d%H%M%S}.ts'.format(RECORDING[0], start),
+                     recsize, 'EP99999999', ''))
+    con.executemany('INSERT INTO recorded VALUES ({})'.format(','.join('?'*16)),
+                    recorded)
+
+    # a GOP every 15 frames, and commercial and cut marks
+    con.executemany('INSERT INTO recordedseek VALUES (?,?,?,?,?)',
+                    ((RECORDING[0], start, i*15, i*15*recsize//(opts.seekrows*15), 9)
+                     for i in range(opts.seekrows)))
+    con.executemany('INSERT INTO recordedmarkup VALUES (?,?,?,?,?)',
+                    ((RECORDING[0], start, i*900, (4, 5, 0, 1)[i % 4], None)
+                     for i in range(opts.markuprows)))
+
+    # Television and Movies, with 1 in 200 entries listed twice, 1 in 100
+    # not hashed yet, 1 in 100 with an extension videotypes does not list,
+    # 1 in 50 on the backend that does not answer and 1 in 50 each on the
+    # backend without a Videos group and on no host
+    videos = []
+    movies = 0
+    for i in range(opts.videos):
+        if i % 50 == 0:
+            title = 'Movie {}'.format(i)
+            filename = 'Movies/{}.mkv'.format(title)
+            season = episode = 0
+            subtitle = ''
+            movies += 1
+        else:
+            show = i % 997
+            season, episode = i % 7 + 1, i % 23 + 1
+            title = 'Show {}'.format(show)
+            subtitle = 'Episode {}'.format(i)
+            filename = 'Television/{0}/Season {1}/{0} - S{1:02d}E{2:02d} - {3}.{4}'\
+                       .format(title, season, episode, i,
+                               'm4v' if i % 100 == 41 else 'mkv')
+        filehash = '' if i % 100 == 7 else '{:x}'.format(rnd.getrandbits(60))
+        host = REMOTE if i % 10 == 3 else DOWN if i % 50 == 37 else \
+               NOGROUP if i % 50 == 19 else '' if i % 50 == 29 else HOST
+        row = (title, subtitle, filename, filehash, host,
+               season, episode, '00000000', rnd.randint(2**28, 2**32))
+        videos.append(row)
+        if i % 200 == 11:
+            videos.append(row)
+    con.executemany("""INSERT INTO videometadata (title, subtitle, filename, hash,
+                           host, season, episode, inetref, filesize, insertdate)
+                       VALUES (?,?,?,?,?,?,?,?,?,'2020-01-01 00:00:00')""", videos)
+    con.executemany('INSERT INTO videotypes VALUES (?,?,0)',
+                    [(ext, 'Internal') for ext in ('mkv', 'mpg', 'ts', 'mp4', 'avi')])
+    con.commit()
+    con.close()
+    return videos, movies
+
+def make_library(work, videos):
+    # An empty file per entry, in the Videos group of its host, leaving out
+    # 1 in 100 and adding as many files no entry knows about. Entries on a
+    # host without a Videos group get none. Returns the entries without a
+    # file on a backend that answers.
+    sg = dict(((group, host), path) for group, host, path in storage_groups(work))
+    for i, (title, subtitle, filename, filehash, host) in \
+            enumerate(row[:5] for row in videos):
+        if ('Videos', host) not in sg:
+            continue
+        if i % 100 == 13:
+            filename = filename.replace('.mkv', ' (orphan).mkv')
+        path = os.path.join(sg[('Videos', host)], filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'a').close()
+    return sum(1 for filename, host in (row[2:5:2] for row in videos)
+               if host != DOWN and ('Videos', host) in sg and
+                  not os.path.exists(os.path.join(sg[('Videos', host)], filename)))
+
+def setup(opts, work):
+    paths = workpaths(work)
+    for group, host, path in storage_groups(work):
+        os.makedirs(path, exist_ok=True)
+    os.makedirs(paths['logs'], exist_ok=True)
+    os.makedirs(os.path.join(work, 'sg', 'Videos', 'Fixtures'), exist_ok=True)
+
+    recsize = int(opts.recsize*2**30)
+    start = datetime.strptime(RECORDING[1], '%Y-%m-%d %H:%M:%S')
+    recpath = os.path.join(work, 'sg', 'Default',
+                           '{}_{:%Y%m%d%H%M%S}.ts'.format(RECORDING[0], start))
+    print('Creating a {:.1f} GB sparse recording'.format(opts.recsize))
+    make_recording(recpath, recsize, opts.seed)
+    fixture = os.path.join(work, 'sg', 'Videos', 'Fixtures', 'hash.ts')
+    make_recording(fixture, recsize, opts.seed + 1)
+
+    print('Creating {} recordings, {} seek rows and {} videos'.format(
+                opts.recordings, opts.seekrows, opts.videos))
+    videos, movies = make_database(paths['template'], opts, recsize, opts.seed)
+    missing = make_library(work, videos)
+
+    config = {'db':paths['db'], 'host':HOST, 'groups':storage_groups(work),
+              'server':None, 'grablatency':opts.grablatency/1000.0,
+              'recording':RECORDING, 'rechash':myth_hash(recpath),
+              'fixturehash':myth_hash(fixture), 'seekrows':opts.seekrows,
+              'markuprows':opts.markuprows, 'hashcalls':opts.hashcalls,
+              'movies':movies, 'videos':len(videos), 'missing':missing, 'down':[DOWN],
+              'recordings':opts.recordings + 1, 'recsize':recsize}
+    return config
+
+#---------------------------
+#   myth:// file server
+#---------------------------
+
+class Handler(socketserver.StreamRequestHandler):
+    # A JSON request per line, answered with a JSON line. read and write
+    # requests continue with the file data and end the connection.
+    def handle(self):
+        server = self.server
+        for line in self.rfile:
+            request = json.loads(line.decode('utf-8'))
+            op = request.pop('op')
+            server.count(op)
+            if op == 'read':
+                return self.send_file(**request)
+            if op == 'write':
+                return self.receive_file(**request)
+            try:
+                reply = {'value':getattr(server, 'op_' + op)(**request)}
+            except Exception as e:
+                reply = {'error':'{}: {}'.format(op, e)}
+            self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+    def send_file(self, group, host, filename, offset=0):
+        path = self.server.resolve(group, host, filename)
+        if not path:
+            self.wfile.write(b'{"error": "no such file"}\n')
+            return
+        with open(path, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            self.wfile.write((json.dumps({'value':size}) + '\n').encode('utf-8'))
+            fp.seek(offset)
+            try:
+                for data in iter(lambda: fp.read(BLOCK), b''):
+                    self.wfile.write(data)
+                    self.server.count('bytes out', len(data))
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    def receive_file(self, group, host, filename, offset=0):
+        # like the backend, a write replaces the file
+        path = self.server.resolve(group, host, filename, new=True)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fp:
+            for data in iter(lambda: self.rfile.read1(BLOCK), b''):
+                fp.write(data)
+                self.server.count('bytes in', len(data))
+        self.wfile.write(b'{"value": true}\n')
+
+class Backend(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, groups, down=()):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.groups = groups
+        self.down = set(down)
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def resolve(self, group, host, filename, new=False):
+        if host in self.down:
+            return None
+        dirs = [path for sgroup, shost, path in self.groups
+                if sgroup == group and shost == host]
+        for dirname in dirs:
+            path = os.path.join(dirname, filename)
+            if os.path.exists(path):
+                return path
+        if new and dirs:
+            return os.path.join(dirs[0], filename)
+        return None
+
+    def op_hash(self, group, host, filename):
+        path = self.resolve(group, host, filename)
+        return myth_hash(path) if path else 'NULL'
+
+    def op_exists(self, group, host, filename):
+        return self.resolve(group, host, filename) is not None
+
+    def op_freespace(self):
+        # in KiB like the backend
+        spaces = []
+        for group, host, path in self.groups:
+            if host in self.down:
+                continue
+            st = os.statvfs(path)
+            spaces.append([host, path, st.f_blocks*st.f_frsize//1024,
+                           (st.f_blocks - st.f_bavail)*st.f_frsize//1024])
+        return spaces
+
+    def op_sglist(self, group, host, path, filenamesonly):
+        # One directory, like QUERY_SG_GETFILELIST. '/' lists the group's
+        # directories, any other path is a directory on that host.
+        if host in self.down:
+            return ['SLAVE UNREACHABLE: ', host]
+        dirs = [dirname for sgroup, shost, dirname in self.groups
+                if sgroup == group and shost == host]
+        entries = []
+        if path == '/':
+            entries = ['sgdir::' + dirname for dirname in dirs]
+        elif os.path.isdir(path) and \
+             any(path.startswith(dirname.rstrip('/') + '/') for dirname in dirs):
+            for name in sorted(os.listdir(path)):
+                full = os.path.join(path, name)
+                if os.path.isdir(full):
+                    if not filenamesonly:
+                        entries.append('dir::{}::0'.format(name))
+                elif filenamesonly:
+                    entries.append(name)
+                else:
+                    entries.append('file::{}::{}'.format(name, os.path.getsize(full)))
+        return entries or ['EMPTY LIST']
+
+    def op_download(self, group, host, filename, url):
+        path = self.resolve(group, host, filename, new=True)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'a').close()
+        return True
+
+    def op_scan(self):
+        return True
+
+#---------------------------
+#   Phases run inside a child process
+#---------------------------
+
+def load_v3():
+    spec = importlib.util.spec_from_file_location('recvid', SCRIPTS['v3'])
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def copy_options():
+    return Values({'interval':30, 'pctstep':10, 'digest':False})
+
+def phase_copy(config, remote):
+    # migrate the recording's file, on this host or through myth://
+    from MythTV import MythDB, MythBE, MythLog, Recorded, Video
+    v3 = load_v3()
+    db = MythDB()
+    host = REMOTE if remote else HOST
+    rec = Recorded(config['recording'], db=db)
+    if remote:
+        rec.hostname = REMOTE
+    vid = Video(db=db).create({'title':rec.title, 'host':host,
+                               'filename':'Bench/{}.ts'.format(host)})
+    start = time.time()
+    srchash, dsthash = v3.copy(vid, rec, None, MythLog('bench'), db, host,
+                               copy_options())
+    seconds = time.time() - start
+    if srchash != config['rechash'] or \
+       (dsthash or MythBE(db=db).getHash(vid.filename, 'Videos', host)) != srchash:
+        raise BenchError('Copy hash mismatch')
+    return seconds, rec.filesize, 0
+
+def phase_copy_local(config):
+    return phase_copy(config, False)
+
+def phase_copy_stream(config):
+    return phase_copy(config, True)
+
+def phase_check_hash(config):
+    # hashcalls backend hash checks of a file in Videos
+    from MythTV import MythDB, MythBE, Video
+    v3 = load_v3()
+    db = MythDB()
+    bend = MythBE(db=db)
+    vid = Video(db=db).create({'title':'Fixture', 'filename':'Fixtures/hash.ts'})
+    start = time.time()
+    for i in range(config['hashcalls']):
+        if not v3.check_hash(vid, bend, config['fixturehash']):
+            raise BenchError('Backend hash mismatch')
+    return time.time() - start, 0, config['hashcalls']
+
+def phase_markup(config, seek):
+    from MythTV import MythDB, Recorded, Video
+    v3 = load_v3()
+    db = MythDB()
+    rec = Recorded(config['recording'], db=db)
+    vid = Video(db=db).create({'title':rec.title, 'filename':'Bench/markup.ts'})
+    start = time.time()
+    if seek:
+        rows = v3.copy_seek(vid, rec, db)
+        expected = config['seekrows']
+    else:
+        rows = v3.copy_markup(vid, rec, db, [0, 1, 4, 5])
+        expected = config['markuprows']
+    seconds = time.time() - start
+    if rows != expected:
+        raise BenchError('{} rows copied, {} expected'.format(rows, expected))
+    return seconds, 0, rows
+
+def phase_copy_seek(config):
+    return phase_markup(config, True)
+
+def phase_copy_markup(config):
+    return phase_markup(config, False)
+
+def phase_v3_resume(config):
+    # A migration through myth:// that dies after its first block, before
+    # any periodic checkpoint, is migrated by the next run rather than taken
+    # for a duplicate of its own partial file. The second run is timed.
+    from MythTV import MythDB, MythBE, MythLog, Recorded
+    v3 = load_v3()
+    db = MythDB()
+    rec = Recorded(config['recording'], db=db)
+    rec.hostname = REMOTE
+    opts = Values({'interval':30, 'pctstep':10, 'digest':False,
+                   'perdevice':2, 'maxtime':None, 'metrics':None, 'promfile':None,
+                   'seekdata':False, 'skiplist':False, 'cutlist':False,
+                   'delete':False, 'safe':False})
+    progress_update = v3.progress_update
+
+    def interrupted(state, done, total):
+        raise IOError('Interrupted by the benchmark')
+
+    v3.progress_update = interrupted
+    status = v3.migrate(rec, opts, db, MythBE(db=db), HOST, MythLog('bench'))
+    if status != 'failed':
+        raise BenchError('The interrupted run ended {}'.format(status))
+    v3.progress_update = progress_update
+    start = time.time()
+    status = v3.migrate(rec, opts, db, MythBE(db=db), HOST, MythLog('bench'))
+    seconds = time.time() - start
+    if status != 'migrated':
+        raise BenchError('The rerun ended {}, not migrated'.format(status))
+    with db as cursor:
+        cursor.execute('SELECT filename, hash FROM videometadata WHERE title=%s',
+                       ('Bench Show',))
+        rows = cursor.fetchall()
+    if len(rows) != 1 or rows[0][1] != config['rechash']:
+        raise BenchError('The rerun left {} Video rows'.format(len(rows)))
+    return seconds, rec.filesize, 0
+
+#---------------------------
+#   Phases run as a script, returning the command and its rows
+#---------------------------
+
+def command_backlog_dryrun(config, opts):
+    return [sys.executable, SCRIPTS['backlog'], '--dry-run', 'title~Show 1%'], \
+           config['recordings']
+
+def command_backlog_queue(config, opts):
+    return [sys.executable, SCRIPTS['backlog'], 'title~Show 1%'], \
+           config['recordings']
+
+def command_vidtool_dedup(config, opts):
+    return [opts.python2, SCRIPTS['vidtool'], '--dedup'], config['videos']
+
+def command_vidtool_hashdedup(config, opts):
+    return [opts.python2, SCRIPTS['vidtool'], '--hashdedup'], config['videos']
+
+def command_vidtool_orphans(config, opts):
+    return [opts.python2, SCRIPTS['vidtool'], '--check_orphans', '--delete_orphans'], \
+           config['videos']
+
+def check_vidtool_orphans(config, work):
+    # only the entries whose file is gone from a backend that answers
+    con = sqlite3.connect(workpaths(work)['db'])
+    left = con.execute('SELECT count(*) FROM videometadata').fetchone()[0]
+    con.close()
+    if left != config['videos'] - config['missing']:
+        raise BenchError('{} entries deleted, {} expected'.format(
+                            config['videos'] - left, config['missing']))
+
+def command_vidtool_update(config, opts):
+    return [opts.python2, SCRIPTS['vidtool'], '--update', '--parallel',
+            '--folder', 'Movies'], config['movies']
+
+def command_v3_help(config, opts):
+    # the cost of starting the script, it should connect to nothing
+    return [sys.executable, SCRIPTS['v3'], '--help'], 0
+
+def command_v3_migrate(config, opts):
+    # a whole job as the backend starts it, startup included
+    return [sys.executable, SCRIPTS['v3'], '--chanid', str(RECORDING[0]),
+            '--startdate', RECORDING[1][:10], '--starttime', RECORDING[1][11:],
+            '--offset', '+00:00', '--seekdata', '--skiplist', '--cutlist'], 1
+
+# name: (runs in a child of this script, needs Python 2)
+PHASES = [('v3_help', False, False), ('v3_migrate', False, False),
+          ('copy_local', True, False), ('copy_stream', True, False),
+          ('check_hash', True, False), ('copy_seek', True, False),
+          ('copy_markup', True, False), ('v3_resume', True, False),
+          ('backlog_dryrun', False, False),
+          ('backlog_queue', False, False), ('vidtool_dedup', False, True),
+          ('vidtool_hashdedup', False, True), ('vidtool_orphans', False, True),
+          ('vidtool_update', False, True)]
+
+#---------------------------
+#   Running and reporting
+#---------------------------
+
+def reset(work):
+    # a fresh database and no output or state from the last run
+    paths = workpaths(work)
+    shutil.copyfile(paths['template'], paths['db'])
+    for dirname in (paths['home'], os.path.join(paths['sg'], 'Videos', 'Bench'),
+                    os.path.join(paths['sg'], 'Videos-remote', 'Bench'),
+                    os.path.join(paths['sg'], 'Videos', 'Television', 'Bench Show')):
+        shutil.rmtree(dirname, ignore_errors=True)
+    open(os.path.join(paths['logs'], 'mythlog.txt'), 'w').close()
+    os.makedirs(paths['home'])
+    for name in os.listdir(work):
+        if name.endswith('.review'):
+            os.remove(os.path.join(work, name))
+
+def run_phase(name, inproc, opts, work, config, server, number):
+    # One run of a phase in its own process. Returns its measurements.
+    paths = workpaths(work)
+    stats = os.path.join(work, 'stats.json')
+    result = os.path.join(work, 'result.json')
+    for path in (stats, result):
+        if os.path.exists(path):
+            os.remove(path)
+    env = dict(os.environ, MYTHBENCH=paths['config'], MYTHBENCH_STATS=stats,
+               MYTHBENCH_LOG=os.path.join(paths['logs'], 'mythlog.txt'),
+               HOME=paths['home'],
+               PYTHONPATH=os.pathsep.join([FAKEDIR] +
+                                          [path for path in os.environ.get('PYTHONPATH',
+                                                                           '').split(os.pathsep) if path]))
+    if inproc:
+        command = [sys.executable, os.path.abspath(__file__), '--child', name,
+                   '--workdir', work]
+        rows = 0
+    else:
+        command, rows = globals()['command_' + name](config, opts)
+
+    reset(work)
+    before = server.snapshot()
+    logpath = os.path.join(paths['logs'], '{}.{}.log'.format(name, number))
+    with open(logpath, 'w') as log:
+        start = time.time()
+        proc = subprocess.Popen(command, cwd=work, env=env, stdout=log,
+                                stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+        pid, status, usage = os.wait4(proc.pid, 0)
+        wall = time.time() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode:
+        raise BenchError('{} exited with {}, see {}'.format(name, proc.returncode,
+                                                          logpath))
+    # some phases also check what they left in the database
+    if 'check_' + name in globals():
+        globals()['check_' + name](config, work)
+    after = server.snapshot()
+
+    measured = {'seconds':wall, 'wall':wall, 'bytes':0, 'rows':rows,
+                'maxrss_kb':usage.ru_maxrss, 'queries':0,
+                'roundtrips':sum(after.get(op, 0) - before.get(op, 0) for op in after
+                                 if not op.startswith('bytes'))}
+    if os.path.exists(result):
+        with open(result) as fp:
+            measured.update(json.load(fp))
+    if os.path.exists(stats):
+        with open(stats) as fp:
+            counted = json.load(fp)
+        measured['queries'] = counted['queries']
+        measured['maxrss_kb'] = counted.get('maxrss_kb', measured['maxrss_kb'])
+    return measured
+
+def summarize(runs):
+    seconds = [run['seconds'] for run in runs]
+    median = statistics.median(seconds)
+    last = runs[-1]
+    return {'seconds':median, 'min':min(seconds), 'max':max(seconds),
+            'wall':statistics.median(run['wall'] for run in runs),
+            'bytes':last['bytes'], 'rows':last['rows'],
+            'mbps':last['bytes']/median/1e6 if median else 0,
+            'rowsps':last['rows']/median if median else 0,
+            'maxrss_kb':max(run['maxrss_kb'] for run in runs),
+            'queries':last['queries'], 'roundtrips':last['roundtrips']}
+
+def report(results):
+    print('{:<18} {:>9} {:>9} {:>9} {:>10} {:>8} {:>8} {:>8}'.format(
+            'phase', 'median s', 'min s', 'MB/s', 'rows/s', 'RSS MB',
+            'queries', 'backend'))
+    for name, res in results.items():
+        print('{:<18} {:>9.3f} {:>9.3f} {:>9.1f} {:>10.0f} {:>8.1f} {:>8} {:>8}'.format(
+                name, res['seconds'], res['min'], res['mbps'], res['rowsps'],
+                res['maxrss_kb']/1024, res['queries'], res['roundtrips']))
+
+def compare(results, baseline, tolerance):
+    # The phases slower or bigger than the baseline allows
+    worse = []
+    limit = 1 + tolerance/100.0
+    for name, res in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for field, label in (('seconds', 'time'), ('maxrss_kb', 'peak RSS')):
+            if base[field] and res[field] > base[field]*limit:
+                worse.append('{}: {} {:.3g} against {:.3g}, {:+.0f}%'.format(
+                        name, label, res[field], base[field],
+                        (res[field]/base[field] - 1)*100))
+    return worse
+
+def child(opts):
+    # run one phase here and leave its measurements in result.json
+    sys.path.insert(0, FAKEDIR)
+    with open(workpaths(opts.workdir)['config']) as fp:
+        config = json.load(fp)
+    seconds, nbytes, rows = globals()['phase_' + opts.child](config)
+    with open(os.path.join(opts.workdir, 'result.json'), 'w') as fp:
+        json.dump({'seconds':seconds, 'bytes':nbytes, 'rows':rows}, fp)
+
+def python2_works(python2):
+    try:
+        return subprocess.call([python2, '-c', 'import sqlite3, json'],
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL) == 0
+    except OSError:
+        return False
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+
+    datagroup = OptionGroup(parser, "Synthetic Data",
+                    "Sizes of the generated recording and tables.")
+    datagroup.add_option("--recsize", action="store", type="float", default=2, dest="recsize",
+            help="Size of the sparse recording in GB, default 2.")
+    datagroup.add_option("--seekrows", action="store", type="int", default=50000, dest="seekrows",
+            help="Seek table rows of the recording, default 50000.")
+    datagroup.add_option("--markuprows", action="store", type="int", default=2000, dest="markuprows",
+            help="Markup rows of the recording, default 2000.")
+    datagroup.add_option("--recordings", action="store", type="int", default=50000, dest="recordings",
+            help="Other recordings, for Myth-Backlog, default 50000.")
+    datagroup.add_option("--videos", action="store", type="int", default=100000, dest="videos",
+            help="Videos in the library, default 100000.")
+    datagroup.add_option("--seed", action="store", type="int", default=1, dest="seed",
+            help="Random seed of the generated data, default 1.")
+    parser.add_option_group(datagroup)
+
+    rungroup = OptionGroup(parser, "Running", "What is run and how often.")
+    rungroup.add_option("--phases", action="store", type="string", dest="phases",
+            help="Comma separated phases to run, default all of " +
+                 ', '.join(name for name, inproc, py2 in PHASES) + '.')
+    rungroup.add_option("--repeat", action="store", type="int", default=3, dest="repeat",
+            help="Runs of each phase, the median is reported, default 3.")
+    rungroup.add_option("--hashcalls", action="store", type="int", default=200, dest="hashcalls",
+            help="Backend hash checks in the check_hash phase, default 200.")
+    rungroup.add_option("--grablatency", action="store", type="float", default=5, dest="grablatency",
+            help="Milliseconds each fake grabber call takes, default 5.")
+    rungroup.add_option("--python2", action="store", type="string", default="python2", dest="python2",
+            help="Python 2 interpreter for Myth-Vid-Tool, default python2.")
+    rungroup.add_option("--workdir", action="store", type="string", dest="workdir",
+            help="Directory for the generated data, default a temporary one.")
+    rungroup.add_option("--keep", action="store_true", default=False, dest="keep",
+            help="Keep the work directory and the logs of each run.")
+    parser.add_option_group(rungroup)
+
+    resultgroup = OptionGroup(parser, "Results",
+                    "Saving results and checking for regressions.")
+    resultgroup.add_option("--save", action="store", type="string", dest="save",
+            help="Write the results to this JSON file.")
+    resultgroup.add_option("--baseline", action="store", type="string", dest="baseline",
+            help="Compare with results saved by --save, exit 1 on a regression.")
+    resultgroup.add_option("--tolerance", action="store", type="float", default=10, dest="tolerance",
+            help="Percent a phase may be slower or bigger than the baseline, default 10.")
+    parser.add_option_group(resultgroup)
+
+    parser.add_option("--child", action="store", type="string", dest="child",
+            help=SUPPRESS_HELP)
+
+    opts, args = parser.parse_args()
+    if opts.child:
+        child(opts)
+        sys.exit(0)
+
+    names = [name for name, inproc, py2 in PHASES]
+    selected = opts.phases.split(',') if opts.phases else names
+    unknown = set(selected) - set(names)
+    if unknown:
+        parser.error('Unknown phases: ' + ', '.join(sorted(unknown)))
+    if any(py2 for name, inproc, py2 in PHASES if name in selected) and \
+       not python2_works(opts.python2):
+        print('No working {}, skipping the Myth-Vid-Tool phases'.format(opts.python2))
+        selected = [name for name, inproc, py2 in PHASES
+                    if name in selected and not py2]
+
+    work = opts.workdir or tempfile.mkdtemp(prefix='Myth-Bench.')
+    os.makedirs(work, exist_ok=True)
+    work = os.path.abspath(work)
+    config = setup(opts, work)
+    server = Backend(config['groups'], config['down'])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    config['server'] = list(server.server_address)
+    with open(workpaths(work)['config'], 'w') as fp:
+        json.dump(config, fp)
+
+    results = {}
+    try:
+        for name, inproc, py2 in PHASES:
+            if name not in selected:
+                continue
+            runs = []
+            for number in range(opts.repeat):
+                runs.append(run_phase(name, inproc, opts, work, config, server, number))
+            results[name] = summarize(runs)
+            print('{} done, {:.3f} s'.format(name, results[name]['seconds']))
+    finally:
+        server.shutdown()
+        if not opts.keep:
+            shutil.rmtree(work, ignore_errors=True)
+
+    report(results)
+    settings = dict((key, getattr(opts, key)) for key in
+                    ('recsize', 'seekrows', 'markuprows', 'recordings', 'videos',
+                     'seed', 'hashcalls', 'grablatency'))
+    if opts.save:
+        with open(opts.save, 'w') as fp:
+            json.dump({'version':__version__, 'settings':settings,
+                       'phases':results}, fp, indent=1)
+    if opts.baseline:
+        with open(opts.baseline) as fp:
+            baseline = json.load(fp)
+        if baseline['settings'] != settings:
+            print('The baseline was made with other settings: {}'.format(
+                        baseline['settings']))
+        worse = compare(results, baseline['phases'], opts.tolerance)
+        for line in worse:
+            print('Regression ' + line)
+        if worse:
+            sys.exit(1)
+    sys.exit(0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,619 @@
+# -*- coding: utf-8 -*-
+
+"""
+    MythTV.py, part of Myth-Bench
+    Copyright (C) 2025  Scott P. Morton PhD
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+#---------------------------
+#   Stand-in for the parts of the MythTV bindings the scripts use, for
+#   Myth-Bench.py only. Never put this directory on the path of a real
+#   system.
+#
+#   The database is an SQLite file holding the tables the scripts touch,
+#   queries are translated from the MySQL dialect on the way in. Backend
+#   calls and myth:// files go to the file server Myth-Bench.py runs on
+#   localhost, so every backend round trip is a real one.
+#
+#   Works under Python 2 and 3, Myth-Vid-Tool.py is still Python 2.
+#---------------------------
+
+import os, re, sys, json, time, zlib, socket, sqlite3, threading, atexit
+from datetime import datetime, timedelta, tzinfo
+
+# Myth-Bench.py writes the configuration and names it in MYTHBENCH
+CONFIG = json.load(open(os.environ['MYTHBENCH']))
+
+# Counted for the run and written to MYTHBENCH_STATS at exit
+STATS = {'queries':0, 'rows':0}
+
+def _dump_stats():
+    # with the peak RSS of this process, the rusage a parent gets also
+    # counts what the process had before it exec'd the script
+    path = os.environ.get('MYTHBENCH_STATS')
+    if not path:
+        return
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    STATS['maxrss_kb'] = int(line.split()[1])
+    except IOError:
+        pass
+    with open(path, 'w') as fp:
+        json.dump(STATS, fp)
+atexit.register(_dump_stats)
+
+class _UTC(tzinfo):
+    def utcoffset(self, dt):
+        return timedelta(0)
+    def dst(self, dt):
+        return timedelta(0)
+    def tzname(self, dt):
+        return 'UTC'
+UTC = _UTC()
+
+TIMEFMT = '%Y-%m-%d %H:%M:%S'
+
+def _to_db(value):
+    # the database holds naive UTC like MythTV 34
+    if value.tzinfo is not None:
+        value = value.astimezone(UTC).replace(tzinfo=None)
+    return value.strftime(TIMEFMT)
+
+def _from_db(value):
+    return datetime.strptime(value.decode('ascii')[:19], TIMEFMT)
+
+sqlite3.register_adapter(datetime, _to_db)
+sqlite3.register_converter('DATETIME', _from_db)
+
+class MythError(Exception):
+    pass
+
+class MythDBError(MythError):
+    pass
+
+#---------------------------
+#   Database
+#---------------------------
+
+def translate(query):
+    # MySQL to SQLite for the statements the scripts issue
+    query = query.replace('%s', '?')
+    query = re.sub(r'(?i)\bSTART TRANSACTION\b', 'BEGIN', query)
+    query = re.sub(r'(?i)\bFOR UPDATE\b', '', query)
+    return re.sub(r'(?i)\bLIKE \?', r"LIKE ? ESCAPE '\\'", query)
+
+class Cursor(object):
+    def __init__(self, con):
+        self._cur = con.cursor()
+
+    def execute(self, query, args=None):
+        STATS['queries'] += 1
+        self._cur.execute(translate(query), tuple(args or ()))
+        return self._cur.rowcount
+
+    def executemany(self, query, args):
+        STATS['queries'] += 1
+        self._cur.executemany(translate(query), [tuple(row) for row in args])
+        return self._cur.rowcount
+
+    def fetchone(self):
+        row = self._cur.fetchone()
+        if row is not None:
+            STATS['rows'] += 1
+        return row
+
+    def fetchmany(self, size=1):
+        rows = self._cur.fetchmany(size)
+        STATS['rows'] += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cur.fetchall()
+        STATS['rows'] += len(rows)
+        return rows
+
+    def close(self):
+        self._cur.close()
+
+    @property
+    def description(self):
+        return self._cur.description
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cur.lastrowid
+
+class StorageGroup(object):
+    def __init__(self, groupname, hostname, dirname):
+        self.groupname = groupname
+        self.hostname = hostname
+        self.dirname = dirname
+
+class MythDB(object):
+    # one SQLite connection per thread, in autocommit like MythDB
+    def __init__(self, *args, **kwargs):
+        self._local = threading.local()
+
+    def _connection(self):
+        con = getattr(self._local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(CONFIG['db'], timeout=60, isolation_level=None,
+                                  detect_types=sqlite3.PARSE_DECLTYPES,
+                                  check_same_thread=False)
+            con.text_factory = str
+            self._local.con = con
+        return con
+
+    def __enter__(self):
+        return Cursor(self._connection())
+
+    def __exit__(self, *exc):
+        return False
+
+    def cursor(self):
+        return Cursor(self._connection())
+
+    def gethostname(self):
+        return CONFIG['host']
+
+    def getStorageGroup(self, groupname=None, hostname=None):
+        for group, host, dirname in CONFIG['groups']:
+            if groupname in (None, group) and hostname in (None, host):
+                yield StorageGroup(group, host, dirname)
+
+    def searchVideos(self, **kwargs):
+        with self as cursor:
+            cursor.execute('SELECT * FROM videometadata')
+            rows = cursor.fetchall()
+        return (Video.fromRaw(row, db=self) for row in rows)
+
+#---------------------------
+#   Backend
+#---------------------------
+
+_CONN = threading.local()
+
+def _call(op, **args):
+    # one request and reply on this thread's control connection
+    conn = getattr(_CONN, 'conn', None)
+    if conn is None:
+        sock = socket.create_connection(tuple(CONFIG['server']))
+        conn = _CONN.conn = (sock, sock.makefile('rb'))
+    args['op'] = op
+    conn[0].sendall((json.dumps(args) + '\n').encode('utf-8'))
+    reply = json.loads(conn[1].readline().decode('utf-8'))
+    if 'error' in reply:
+        raise MythError(reply['error'])
+    return reply['value']
+
+class FreeSpace(object):
+    def __init__(self, host, path, totalspace, usedspace):
+        self.host = host
+        self.path = path
+        self.totalspace = totalspace
+        self.usedspace = usedspace
+
+class MythBE(object):
+    def __init__(self, backend=None, db=None):
+        self.db = db or MythDB()
+
+    def getHash(self, filename, group, host=None):
+        return _call('hash', group=group, host=host or CONFIG['host'],
+                     filename=filename)
+
+    def fileExists(self, filename, group='Default'):
+        return _call('exists', group=group, host=CONFIG['host'],
+                     filename=filename)
+
+    def getFreeSpace(self, all=False):
+        return [FreeSpace(*entry) for entry in _call('freespace')]
+
+    def getSGList(self, host, group, path, filenamesonly=False):
+        # as the bindings, one directory per request. The names as sent with
+        # filenamesonly, else -1 for an empty listing, -2 for an unreachable
+        # host or (dirs, files, sizes)
+        path = path.rstrip('/') + '/'
+        res = _call('sglist', group=group, host=host, path=path,
+                    filenamesonly=bool(filenamesonly))
+        if filenamesonly:
+            return res
+        elif res[0] == 'EMPTY LIST':
+            return -1
+        elif res[0] == 'SLAVE UNREACHABLE: ':
+            return -2
+        dirs = []
+        files = []
+        sizes = []
+        for entry in res:
+            spl = entry.split('::')
+            if spl[0] == 'file':
+                files.append(spl[1])
+                sizes.append(spl[2])
+            if spl[0] == 'dir':
+                dirs.append(spl[1])
+        return (dirs, files, sizes)
+
+    def downloadTo(self, url, group, filename, forceremote=False, openfile=False):
+        return _call('download', group=group, host=CONFIG['host'],
+                     filename=filename, url=url)
+
+    def scanVideos(self):
+        return _call('scan')
+
+class FileTransfer(object):
+    # A myth:// file, read from the offset it is opened at or written whole
+    def __init__(self, mode, group, host, filename):
+        self.mode = mode
+        self._args = {'group':group, 'host':host, 'filename':filename}
+        self._pos = 0
+        self._open()
+
+    def _open(self):
+        self._sock = socket.create_connection(tuple(CONFIG['server']))
+        args = dict(self._args, op='write' if 'w' in self.mode else 'read',
+                    offset=self._pos)
+        self._sock.sendall((json.dumps(args) + '\n').encode('utf-8'))
+        self._fp = self._sock.makefile('rb')
+        if 'w' not in self.mode:
+            reply = json.loads(self._fp.readline().decode('utf-8'))
+            if 'error' in reply:
+                raise MythError(reply['error'])
+            self.size = reply['value']
+
+    def read(self, size=-1):
+        data = self._fp.read(size)
+        self._pos += len(data)
+        return data
+
+    def write(self, data):
+        self._sock.sendall(data)
+        self._pos += len(data)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.size
+        if 'w' in self.mode or offset == self._pos:
+            return
+        self._close()
+        self._pos = offset
+        self._open()
+
+    def tell(self):
+        return self._pos
+
+    def _close(self):
+        self._fp.close()
+        self._sock.close()
+
+    def close(self):
+        if 'w' in self.mode:
+            # the server answers once everything sent is on disk
+            self._sock.shutdown(socket.SHUT_WR)
+            self._fp.readline()
+        self._close()
+
+#---------------------------
+#   Rows
+#---------------------------
+
+class DBData(object):
+    # A table row, fields read and written as attributes or items
+    _table = None
+    _key = None
+    _fields = {}
+
+    def __init__(self, data=None, db=None):
+        self.__dict__['_db'] = db or MythDB()
+        self.__dict__['_data'] = {}
+        if data is None:
+            # a new row, every field unset until create()
+            self._data.update(dict.fromkeys(self._field_order(self._db)))
+            return
+        if not isinstance(data, (tuple, list)):
+            data = (data,)
+        where = ' AND '.join('{0}=%s'.format(key) for key in self._key)
+        with self._db as cursor:
+            cursor.execute('SELECT * FROM {0} WHERE {1}'.format(self._table, where),
+                           self._keyargs(data))
+            row = cursor.fetchone()
+        if row is None:
+            raise MythError('No {0} entry for {1}'.format(self._table, data))
+        self._load(row)
+
+    def _keyargs(self, data):
+        return list(data)
+
+    @classmethod
+    def _field_order(cls, db):
+        if cls._table not in DBData._fields:
+            with db as cursor:
+                cursor.execute('SELECT * FROM {0} LIMIT 0'.format(cls._table))
+                DBData._fields[cls._table] = [desc[0] for desc in cursor.description]
+        return DBData._fields[cls._table]
+
+    def _load(self, row):
+        self._data.update(zip(self._field_order(self._db), row))
+
+    @classmethod
+    def fromRaw(cls, raw, db=None):
+        obj = cls(db=db)
+        obj._load(raw)
+        return obj
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['_data'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self._data[name] = value
+
+    def __getitem__(self, name):
+        return self._data[name]
+
+    def __setitem__(self, name, value):
+        self._data[name] = value
+
+    def get(self, name, default=None):
+        return self._data.get(name, default)
+
+    def keys(self):
+        return list(self._data)
+
+    def _where(self):
+        return (' AND '.join('{0}=%s'.format(key) for key in self._key),
+                [self._data[key] for key in self._key])
+
+    def update(self, *args, **kwargs):
+        for data in args:
+            self._data.update(data)
+        self._data.update(kwargs)
+        fields = [field for field in self._field_order(self._db)
+                  if field in self._data and field not in self._key]
+        where, args = self._where()
+        with self._db as cursor:
+            cursor.execute('UPDATE {0} SET {1} WHERE {2}'.format(self._table,
+                                ', '.join('{0}=%s'.format(field) for field in fields),
+                                where),
+                           [self._data[field] for field in fields] + args)
+
+    def delete(self):
+        where, args = self._where()
+        with self._db as cursor:
+            cursor.execute('DELETE FROM {0} WHERE {1}'.format(self._table, where),
+                           args)
+
+class Grabbed(dict):
+    # grabber results and exported metadata, items also read as attributes
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+METADATA = ('title', 'subtitle', 'tagline', 'plot', 'year', 'inetref',
+            'season', 'episode', 'director', 'category', 'rating', 'length')
+
+class Video(DBData):
+    _table = 'videometadata'
+    _key = ('intid',)
+
+    def create(self, data=None):
+        self._data.update(data or {})
+        self._data.setdefault('host', CONFIG['host'])
+        fields = [field for field in self._field_order(self._db)
+                  if field in self._data and field != 'intid']
+        with self._db as cursor:
+            cursor.execute('INSERT INTO videometadata ({0}) VALUES ({1})'.format(
+                                ', '.join(fields), ', '.join(['%s']*len(fields))),
+                           [self._data[field] for field in fields])
+            self._data['intid'] = cursor.lastrowid
+        return self
+
+    def delete(self):
+        with self._db as cursor:
+            for table in ('videometadatacast', 'videometadatagenre',
+                          'videometadatacountry'):
+                cursor.execute('DELETE FROM {0} WHERE idvideo=%s'.format(table),
+                               (self.intid,))
+        DBData.delete(self)
+
+    def open(self, mode='r'):
+        return FileTransfer(mode, 'Videos', self.get('host') or CONFIG['host'],
+                            self.filename)
+
+    def importMetadata(self, metadata, overwrite=False):
+        for field in METADATA:
+            if metadata.get(field) is not None:
+                self._data[field] = metadata.get(field)
+        self.update()
+
+    def exportMetadata(self):
+        data = Grabbed((field, self._data.get(field)) for field in METADATA)
+        data['images'] = []
+        return data
+
+class Recorded(DBData):
+    _table = 'recorded'
+    _key = ('chanid', 'starttime')
+
+    def _keyargs(self, data):
+        chanid, starttime = data
+        if not isinstance(starttime, datetime):
+            starttime = datetime.strptime(str(starttime)[:19], TIMEFMT)
+        return [int(chanid), starttime]
+
+    def _load(self, row):
+        DBData._load(self, row)
+        # the bindings hand out aware local times, UTC serves here
+        for field in ('starttime', 'endtime'):
+            if isinstance(self._data.get(field), datetime):
+                self._data[field] = self._data[field].replace(tzinfo=UTC)
+
+    def _where(self):
+        return 'chanid=%s AND starttime=%s', [self.chanid, self.starttime]
+
+    def open(self, mode='r'):
+        return FileTransfer(mode, self.storagegroup, self.hostname, self.basename)
+
+    def exportMetadata(self):
+        data = Grabbed((field, self._data.get(field)) for field in METADATA)
+        data['images'] = []
+        return data
+
+class Job(DBData):
+    _table = 'jobqueue'
+    _key = ('id',)
+
+    NONE        = 0x0000
+    SYSTEMJOB   = 0x00ff
+    TRANSCODE   = 0x0001
+    COMMFLAG    = 0x0002
+    METADATA    = 0x0004
+    PREVIEW     = 0x0008
+    USERJOB     = 0xff00
+    USERJOB1    = 0x0100
+    USERJOB2    = 0x0200
+    USERJOB3    = 0x0400
+    USERJOB4    = 0x0800
+
+    RUN         = 0x0000
+    PAUSE       = 0x0001
+    RESUME      = 0x0002
+    STOP        = 0x0004
+    RESTART     = 0x0008
+
+    NO_FLAGS    = 0x0000
+    USE_CUTLIST = 0x0001
+    LIVE_REC    = 0x0002
+    EXTERNAL    = 0x0004
+    REBUILD     = 0x0008
+
+    UNKNOWN     = 0x0000
+    QUEUED      = 0x0001
+    PENDING     = 0x0002
+    STARTING    = 0x0003
+    RUNNING     = 0x0004
+    STOPPING    = 0x0005
+    PAUSED      = 0x0006
+    RETRY       = 0x0007
+    ERRORING    = 0x0008
+    ABORTING    = 0x0009
+    DONE        = 0x0100
+    FINISHED    = 0x0110
+    ABORTED     = 0x0120
+    ERRORED     = 0x0130
+    CANCELLED   = 0x0140
+
+    def setStatus(self, status):
+        self.status = status
+        self.update()
+
+    def setComment(self, comment):
+        self.comment = comment
+        self.update()
+
+    @classmethod
+    def fromRecorded(cls, rec, type, status=None, hostname='', args='', flags=0):
+        now = datetime.utcnow()
+        job = cls(db=rec._db)
+        with job._db as cursor:
+            cursor.execute("""INSERT INTO jobqueue (chanid, starttime, inserttime, type,
+                                  cmds, flags, status, statustime, hostname, args,
+                                  comment, schedruntime)
+                              VALUES (%s,%s,%s,%s,0,%s,%s,%s,%s,%s,'',%s)""",
+                           (rec.chanid, rec.starttime, now, type, flags,
+                            status or cls.QUEUED, now, hostname, args, now))
+            cursor.execute('SELECT * FROM jobqueue WHERE id=%s', (cursor.lastrowid,))
+            job._load(cursor.fetchone())
+        return job
+
+#---------------------------
+#   Everything else
+#---------------------------
+
+class MythLog(object):
+    # levels and masks as in the bindings, messages go to MYTHBENCH_LOG
+    NONE = 0;  GENERAL = 1;  RECORD = 2;  PLAYBACK = 4;  CHANNEL = 8
+    OSD = 16;  FILE = 32;    SCHEDULE = 64;  NETWORK = 128;  DATABASE = 256
+    ALL = -1
+    EMERG = 0; ALERT = 1; CRIT = 2; ERR = 3; WARNING = 4; NOTICE = 5
+    INFO = 6;  DEBUG = 7
+
+    helptext = 'Log levels are not used by the stand-in'
+
+    def __init__(self, module='', db=None):
+        self.module = module
+
+    @classmethod
+    def loadOptParse(cls, parser):
+        parser.add_option('--verbose', action='store', type='string', dest='verbose',
+                          help='Ignored by the stand-in')
+        parser.add_option('--logpath', action='store', type='string', dest='logpath',
+                          help='Directory for the log file')
+
+    def _setfile(self, path):
+        os.environ['MYTHBENCH_LOG'] = path
+
+    def _setlevel(self, level):
+        pass
+
+    def logTB(self, mask, *args):
+        import traceback
+        self(mask, self.ERR, 'Traceback', traceback.format_exc())
+
+    def __call__(self, mask, level, message, detail=None):
+        path = os.environ.get('MYTHBENCH_LOG')
+        if path:
+            with open(path, 'a') as fp:
+                fp.write('{0} {1} {2}\n'.format(self.module, message, detail or ''))
+
+    def log(self, mask, level, message, detail=None):
+        self(mask, level, message, detail)
+
+class static(object):
+    class MARKUP(object):
+        # the values the bindings give them
+        MARK_CUT_END = 0
+        MARK_CUT_START = 1
+        MARK_COMM_START = 4
+        MARK_COMM_END = 5
+
+class VideoGrabber(object):
+    # Answers every search with one match after MYTHBENCH grablatency
+    # seconds, like a grabber would after its network requests
+    def __init__(self, mode, lang='en', db=None):
+        self.mode = mode
+
+    def sortedSearch(self, phrase, subtitle=None):
+        time.sleep(CONFIG.get('grablatency', 0))
+        return [Grabbed(title=phrase, subtitle=subtitle, year=2000,
+                        inetref=str(zlib.crc32(phrase.encode('utf-8')) % 10**6))]
+
+    def grabInetref(self, inetref, season=None, episode=None):
+        time.sleep(CONFIG.get('grablatency', 0))
+        return Grabbed(title='Title ' + str(inetref), description='Plot',
+                       inetref=inetref, season=season, episode=episode,
+                       year=2000, images=[])
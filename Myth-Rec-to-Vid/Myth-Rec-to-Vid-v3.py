@@ -42,10 +42,12 @@ __version__= "v3.1.3"
 
 from MythTV import MythDB, Job, Recorded, Video, VideoGrabber,\
                    MythLog, static, MythBE    
-from optparse import OptionParser, OptionGroup
+from optparse import OptionParser, OptionGroup, SUPPRESS_HELP
 
-import sys, os, time
-from datetime import datetime
+import sys, os, re, time, errno, fcntl, queue, threading, hashlib, struct, json
+import sqlite3, atexit, cProfile, pstats, tracemalloc, signal
+from contextlib import contextmanager, ExitStack
+from datetime import datetime, timezone
 
 # Global Constants
 
@@ -68,13 +70,145 @@ MVFMT = 'Movies/%TITLE%'
 #    %STORAGEGROUP%:  storage group containing recorded show
 #    %GENRE%:         first genre listed for recording
 
-# an exit path
+# How each tag is rendered, the recording field and its format
+TAGS = {'TITLE':('title', '{}'),           'SUBTITLE':('subtitle', '{}'),
+        'SEASON':('season', '{}'),         'SEASONPAD':('season', '{:02d}'),
+        'EPISODE':('episode', '{}'),       'EPISODEPAD':('episode', '{:02d}'),
+        'YEAR':('year', '{}'),             'DIRECTOR':('director', '{}'),
+        'HOSTNAME':('hostname', '{}'),     'STORAGEGROUP':('storagegroup', '{}'),
+        'GENRE':('genre', '{}')}
+
+# Characters not allowed in a name, replaced with UNSAFEREPL
+UNSAFE = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
+UNSAFEREPL = '_'
+
+# Compiled formats, see compile_fmt()
+FORMATS = {}
+
+# Transfer block size, used by both the myth:// stream and the local copy
+CHUNK = 2**24
+
+# CHUNK sized buffers shared by the reader and writer of a myth:// stream
+BUFFERS = 3
+
+# Bytes hashed at each end of the file, see FileHash() in libmythbase
+HASHWINDOW = 2**16
+
+# ioctl request to clone (reflink) a file on btrfs/xfs, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+# Working files (transfer slot locks, copy checkpoints, space reservations,
+# transfer rates, the video index) shared by every run on this machine
+STATEDIR = os.path.expanduser('~/.mythtv/Myth-Rec-to-Vid')
+
+# Bytes copied between checkpoints of an interrupted myth:// stream
+CHECKPOINT = 2**28
+
+# Bytes kept free in the Videos group on top of the copies in progress
+SPACEMARGIN = 2**30
+
+# Seconds between attempts to get a transfer slot held by another process
+SLOTWAIT = 5
+
+# Weight of the newest sample in the smoothed transfer rate
+RATEWEIGHT = 0.2
+
+# Rows per INSERT statement when copying seek and markup data
+ROWBATCH = 1000
+
+# Keys of every Video for dup_check(), kept in STATEDIR/videos.sqlite and
+# loaded once per process. claims holds the keys of migrations in progress.
+INDEX = {'keys':None, 'claims':{}, 'lock':threading.Lock()}
+
+# Version of video_keys(), a stored index made by another version is rebuilt
+KEYVERSION = 2
+
+# Prefix of the names written to --promfile
+PROMPREFIX = 'mythrectovid'
+
+# When this module was loaded, see startup_seconds()
+STARTED = time.time()
+
+# Exported recording metadata written with the new Video row, and the
+# column each goes to. importMetadata() adds people, genres and artwork.
+METAFIELDS = {'title':'title', 'subtitle':'subtitle', 'tagline':'tagline',
+              'description':'plot', 'season':'season', 'episode':'episode',
+              'inetref':'inetref', 'year':'year', 'releasedate':'releasedate',
+              'userrating':'userrating'}
+
+# What --profile collects, see profile_start(). chunks is None unless the
+# copy block timings are sampled, then a list of (kind, seconds, bytes).
+PROFILE = {'cpu':False, 'profilers':[], 'chunks':None}
+
+# Most copy block timings kept, and allocation sites logged, by --profile
+PROFILESAMPLES = 100000
+PROFILETOP = 25
+
+# Seconds a --daemon waits between looks at the jobqueue when it is idle
+POLLWAIT = 10
+
+# Queued jobs a --daemon tries in turn when another one takes them first
+CLAIMBATCH = 10
+
+# an exit path, returns the status for migrate()
 
 def error_out(vid, thisJob):
-    vid.delete()
+    index_release(vid['filename'])
+    # the row only exists once the copy was verified
+    if vid.intid:
+        vid.delete()
     if thisJob:
         thisJob.setStatus(Job.ERRORED)
-    sys.exit(1)
+    return 'failed'
+
+def compile_fmt(fmt):
+    # Split a format into literal strings and (field, format) pairs once,
+    # the result is kept in FORMATS for every later name built from it
+    if fmt not in FORMATS:
+        tokens = []
+        for n, part in enumerate(re.split(r'%([A-Z]+)%', fmt)):
+            if n % 2 == 0:
+                if part:
+                    tokens.append(part)
+            elif part in TAGS:
+                tokens.append(TAGS[part])
+            else:
+                tokens.append('%{}%'.format(part))
+        FORMATS[fmt] = tokens
+    return FORMATS[fmt]
+
+def recording_fields(rec):
+    # Getters for the fields a format can use, only the ones used are read
+    def year():
+        airdate = rec['originalairdate']
+        return getattr(airdate, 'year', None)
+    def director():
+        for person in rec.cast:
+            if person.role == 'director':
+                return person.name
+    return {'title':lambda: rec['title'], 'subtitle':lambda: rec['subtitle'],
+            'season':lambda: rec['season'], 'episode':lambda: rec['episode'],
+            'year':year, 'director':director,
+            'hostname':lambda: rec['hostname'],
+            'storagegroup':lambda: rec['storagegroup'],
+            'genre':lambda: rec['category']}
+
+def render_fmt(fmt, fields):
+    # Fill in a format, empty fields render as nothing and characters that
+    # are unsafe in a file name are replaced
+    out = []
+    for token in compile_fmt(fmt):
+        if isinstance(token, str):
+            out.append(token)
+            continue
+        field, form = token
+        value = fields[field]()
+        if value in (None, ''):
+            continue
+        if form != '{}':
+            value = int(value)
+        out.append(UNSAFE.sub(UNSAFEREPL, form.format(value)).strip(' .'))
+    return ''.join(out)
 
 def getType(rec):
     if rec.programid[:2] == 'MV':
@@ -82,13 +216,131 @@ def getType(rec):
     else:
         return 'TV'
 
-def dup_check(vid, rec, thisJob, bend, log):
+def normalize(text):
+    # letters and digits of any script, without case
+    return re.sub(r'[\W_]+', '', '{}'.format(text or '').casefold())
+
+def video_keys(filename, title, season, episode, inetref, filehash, movie):
+    # Every key under which an existing video makes a new one a duplicate:
+    # the file name without case, punctuation or extension, the episode,
+    # the inetref and the file hash. A TV inetref names the series, so it
+    # is only a key per episode, and not at all without season or episode.
+    keys = ['file:' + normalize(os.path.splitext(filename or '')[0])]
+    hasref = inetref and inetref != '00000000'
+    if season or episode:
+        keys.append('episode:{}:{}:{}'.format(normalize(title), season, episode))
+        if hasref:
+            keys.append('inetref:{}:{}:{}'.format(inetref, season, episode))
+    elif hasref and movie:
+        keys.append('inetref:{}'.format(inetref))
+    if filehash and filehash != 'NULL':
+        keys.append('hash:{}'.format(filehash))
+    return keys
+
+def stored_movie(subtitle, season, episode):
+    # a Video row is taken for a movie when it has no episode information
+    return not (subtitle or season or episode)
+
+def fetch_keys(db, lastid):
+    rows = fetch_rows(db, """SELECT intid, filename, title, season, episode,
+                                    inetref, hash, subtitle
+                             FROM videometadata WHERE intid>%s""", [lastid])
+    keys = []
+    for intid, filename, title, season, episode, inetref, filehash, subtitle in rows:
+        keys += [(intid, key) for key in
+                 video_keys(filename, title, season, episode, inetref, filehash,
+                            stored_movie(subtitle, season, episode))]
+    return keys
+
+def refresh_index(db):
+    # Bring the index up to date with videometadata. Rows past the last
+    # intid seen are added. If the row count then differs, rows were
+    # deleted and the index is rebuilt. Call with INDEX['lock'] held.
+    os.makedirs(STATEDIR, exist_ok=True)
+    con = sqlite3.connect(os.path.join(STATEDIR, 'videos.sqlite'))
+    try:
+        con.execute('CREATE TABLE IF NOT EXISTS videokeys (intid INTEGER, key TEXT)')
+        con.execute('CREATE INDEX IF NOT EXISTS videokeys_intid ON videokeys (intid)')
+        if con.execute('PRAGMA user_version').fetchone()[0] != KEYVERSION:
+            con.execute('DELETE FROM videokeys')
+            con.execute('PRAGMA user_version={}'.format(KEYVERSION))
+            INDEX['keys'] = None
+        with db as cursor:
+            cursor.execute('SELECT COUNT(*), MAX(intid) FROM videometadata')
+            count, maxid = cursor.fetchone()
+        lastid = con.execute('SELECT MAX(intid) FROM videokeys').fetchone()[0] or 0
+        new = fetch_keys(db, lastid) if lastid <= (maxid or 0) else []
+        con.executemany('INSERT INTO videokeys VALUES (?,?)', new)
+        known = con.execute('SELECT COUNT(DISTINCT intid) FROM videokeys').fetchone()[0]
+        if lastid > (maxid or 0) or known != count:
+            con.execute('DELETE FROM videokeys')
+            con.executemany('INSERT INTO videokeys VALUES (?,?)', fetch_keys(db, 0))
+            INDEX['keys'] = None
+        con.commit()
+
+        if INDEX['keys'] is None:
+            INDEX['keys'] = set(key for (key,) in con.execute('SELECT key FROM videokeys'))
+            for keys in INDEX['claims'].values():
+                INDEX['keys'].update(keys)
+        else:
+            INDEX['keys'].update(key for intid, key in new)
+    finally:
+        con.close()
+
+def index_add(vid):
+    # Store the keys of a finished migration under its intid
+    keys = video_keys(vid.filename, vid.title, vid.season, vid.episode,
+                      vid.inetref, vid.hash,
+                      stored_movie(vid.subtitle, vid.season, vid.episode))
+    with INDEX['lock']:
+        INDEX['claims'].pop(vid.filename, None)
+        if INDEX['keys'] is not None:
+            INDEX['keys'].update(keys)
+        con = sqlite3.connect(os.path.join(STATEDIR, 'videos.sqlite'))
+        try:
+            con.execute('DELETE FROM videokeys WHERE intid=?', (vid.intid,))
+            con.executemany('INSERT INTO videokeys VALUES (?,?)',
+                            [(vid.intid, key) for key in keys])
+            con.commit()
+        finally:
+            con.close()
+
+def index_release(filename):
+    # Give back the keys claimed by a migration that did not finish
+    with INDEX['lock']:
+        keys = INDEX['claims'].pop(filename, [])
+        if INDEX['keys'] is not None:
+            INDEX['keys'].difference_update(keys)
+
+def dup_check(vid, rec, thisJob, bend, log, db):
+    # Answered from the video index and the local disk, the backend is only
+    # asked when the Videos group is not on this machine. Keys of a new
+    # video are claimed so a concurrent migration of the same episode is
+    # also caught.
     log(log.GENERAL, log.INFO, 'Processing new file name ',
                 '{0}'.format(vid['filename']))
     log(log.GENERAL, log.INFO, 'Checking for duplication of ',
                 '{0} - {1}'.format(rec['title'], 
                              rec['subtitle']))
-    if bend.fileExists(vid['filename'], 'Videos'):
+    srcpath = find_local(db, rec['hostname'], rec['storagegroup'], rec['basename'])
+    keys = video_keys(vid['filename'], rec['title'], rec['season'],
+                      rec['episode'], rec['inetref'],
+                      hash_final(file_hash(srcpath)) if srcpath else None,
+                      getType(rec) == 'MOVIE')
+    dstpath = find_local(db, vid['host'], 'Videos', vid['filename'], new=True)
+    if dstpath:
+        exists = os.path.exists(dstpath)
+    else:
+        exists = bend.fileExists(vid['filename'], 'Videos')
+
+    with INDEX['lock']:
+        refresh_index(db)
+        found = exists or any(key in INDEX['keys'] for key in keys)
+        if not found:
+            INDEX['claims'][vid['filename']] = keys
+            INDEX['keys'].update(keys)
+
+    if found:
         log(log.GENERAL, log.INFO, 'Recording already exists in Myth Videos')
         if thisJob:
             thisJob.setComment("Action would result in duplicate entry" )
@@ -100,60 +352,820 @@ def dup_check(vid, rec, thisJob, bend, log):
                              rec['subtitle']))
         return False 
 
-def copy(vid, rec, thisJob, log):
-    stime = time.time()
-    srcsize = rec.filesize
-    htime = [stime,stime,stime,stime]
+def hash_init(size, digest=False):
+    # Running state of the MythTV file hash, optionally with a BLAKE2
+    # digest of the whole content
+    return {'size':size, 'head':bytearray(), 'tail':bytearray(),
+            'digest':hashlib.blake2b() if digest else None}
+
+def hash_update(state, offset, data):
+    # Feed the bytes found at offset, pieces must arrive in file order
+    head = state['head']
+    if offset <= len(head) < HASHWINDOW:
+        head += data[len(head)-offset:HASHWINDOW-offset]
+    tail = state['tail']
+    tailstart = max(state['size'] - HASHWINDOW, 0)
+    if offset <= tailstart + len(tail) < offset + len(data):
+        tail += data[tailstart+len(tail)-offset:]
+    if state['digest']:
+        state['digest'].update(data)
+
+def hash_final(state):
+    # Same value as MythBE.getHash(): size plus the little endian 64 bit
+    # words of the first and last 64 KiB, in unpadded hex
+    if not state['size']:
+        return 'NULL'
+    total = state['size']
+    for window in (state['head'], state['tail']):
+        words = len(window)//8
+        total += sum(struct.unpack('<{}Q'.format(words), window[:words*8]))
+    return '{:x}'.format(total & 0xFFFFFFFFFFFFFFFF)
+
+def file_hash(path, digest=False):
+    # Hash a local file, only the two windows are read unless digest is set
+    size = os.path.getsize(path)
+    state = hash_init(size, digest)
+    with open(path, 'rb') as fp:
+        if digest:
+            offset = 0
+            for data in iter(lambda: fp.read(CHUNK), b''):
+                hash_update(state, offset, data)
+                offset += len(data)
+        else:
+            hash_update(state, 0, fp.read(HASHWINDOW))
+            offset = max(size - HASHWINDOW, 0)
+            fp.seek(offset)
+            hash_update(state, offset, fp.read())
+    return state
+
+def find_local(db, host, sgroup, filename, new=False):
+    # Resolve a storage group file to a path on this machine. Returns None
+    # if the group does not live here, or (unless new) the file is missing.
+    if host != db.gethostname():
+        return None
+    dirs = [sg.dirname for sg in db.getStorageGroup(groupname=sgroup,
+                                                   hostname=host)
+                       if os.path.isdir(sg.dirname)]
+    for dirname in dirs:
+        path = os.path.join(dirname, filename)
+        if os.path.exists(path):
+            return path
+    if new and dirs:
+        # same rule as the backend, the directory with the most free space
+        dirname = max(dirs, key=lambda d: os.statvfs(d).f_bavail *
+                                          os.statvfs(d).f_frsize)
+        return os.path.join(dirname, filename)
+    return None
+
+def local_copy(srcpath, dstpath, report, digest=False):
+    # Copy entirely inside the kernel, the data never enters this process.
+    # Returns the method used and the hash states of source and destination,
+    # both hashed from the local disks so no backend query is needed. Never
+    # a hard link: the backend truncates a deleted recording in place when
+    # deleting slowly, which would empty the video sharing its inode.
+    os.makedirs(os.path.dirname(dstpath), exist_ok=True)
+    srcsize = os.path.getsize(srcpath)
+    samefs = os.stat(srcpath).st_dev == \
+             os.stat(os.path.dirname(dstpath)).st_dev
+    method = kernel_copy(srcpath, dstpath, srcsize, report, samefs)
+    return method, file_hash(srcpath), file_hash(dstpath, digest)
+
+def kernel_copy(srcpath, dstpath, srcsize, report, samefs):
+    # reflink when the filesystem can share extents, else copy in the kernel
+    with open(srcpath, 'rb') as srcfp, open(dstpath, 'wb') as dstfp:
+        if samefs:
+            try:
+                fcntl.ioctl(dstfp.fileno(), FICLONE, srcfp.fileno())
+                report(srcsize, srcsize)
+                return 'reflink'
+            except OSError:
+                pass
+
+        method = 'copy_file_range' if hasattr(os, 'copy_file_range') \
+                                   else 'sendfile'
+        done = 0
+        while done < srcsize:
+            tsize = min(CHUNK, srcsize - done)
+            started = time.perf_counter()
+            if method == 'copy_file_range':
+                try:
+                    tsize = os.copy_file_range(srcfp.fileno(),
+                                               dstfp.fileno(), tsize)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.ENOSYS,
+                                       errno.EINVAL, errno.EOPNOTSUPP):
+                        raise
+                    method = 'sendfile'
+                    continue
+            else:
+                tsize = os.sendfile(dstfp.fileno(), srcfp.fileno(),
+                                    None, tsize)
+            if tsize == 0:
+                raise IOError('Short read from {}'.format(srcpath))
+            chunk_sample(method, started, tsize)
+            done += tsize
+            report(done, srcsize)
+    return method
+
+def devices(rec, host):
+    # The storage groups a migration reads and writes, concurrency is
+    # limited per entry
+    return ['{}.{}'.format(rec['hostname'], rec['storagegroup']),
+            '{}.Videos'.format(host)]
+
+def take_slot(key, limit):
+    # Lock one of limit slot files for key, waiting until one is free.
+    # flock is per open file, so this holds between threads and processes.
+    names = [os.path.join(STATEDIR, '{}.{}.lock'.format(key.replace('/', '_'), n))
+             for n in range(limit)]
+    while True:
+        for name in names:
+            fp = open(name, 'a')
+            try:
+                fcntl.flock(fp, fcntl.LOCK_EX|fcntl.LOCK_NB)
+                return fp
+            except OSError:
+                fp.close()
+        time.sleep(SLOTWAIT)
+
+@contextmanager
+def device_slots(keys, limit):
+    # Hold a slot on every device, always taken in the same order
+    os.makedirs(STATEDIR, exist_ok=True)
+    held = []
+    try:
+        for key in sorted(set(keys)):
+            held.append(take_slot(key, limit))
+        yield
+    finally:
+        for fp in held:
+            fp.close()
+
+def schedule(recs, host, workers, limit, run):
+    # Run recs on workers threads, largest first among those whose devices
+    # are below limit so one busy disk does not stall the others. Largest
+    # first keeps a long copy from starting last and stretching the batch.
+    pending = sorted(recs, key=lambda rec: rec['filesize'], reverse=True)
+    busy = {}
+    results = {}
+    cond = threading.Condition()
+
+    def ready():
+        for rec in pending:
+            if all(busy.get(key, 0) < limit for key in devices(rec, host)):
+                return rec
+        return None
+
+    def worker():
+        while True:
+            with cond:
+                rec = ready()
+                while pending and rec is None:
+                    cond.wait()
+                    rec = ready()
+                if rec is None:
+                    return
+                pending.remove(rec)
+                for key in devices(rec, host):
+                    busy[key] = busy.get(key, 0) + 1
+            try:
+                results[id(rec)] = run(rec)
+            finally:
+                with cond:
+                    for key in devices(rec, host):
+                        busy[key] -= 1
+                    cond.notify_all()
+
+    threads = [threading.Thread(target=worker, name='worker{}'.format(n))
+               for n in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [results[id(rec)] for rec in recs]
+
+def update_table(name, change):
+    # Load the JSON table name from STATEDIR, let change() modify it and
+    # save it, all under a lock. Returns what change() returns.
+    os.makedirs(STATEDIR, exist_ok=True)
+    path = os.path.join(STATEDIR, name + '.json')
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(path) as fp:
+                table = json.load(fp)
+        except (IOError, ValueError):
+            table = {}
+        result = change(table)
+        with open(path + '.tmp', 'w') as fp:
+            json.dump(table, fp)
+        os.replace(path + '.tmp', path)
+    return result
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def free_space(db, bend, host, dstpath):
+    # Bytes free in Videos where dstpath (None if remote) will be written,
+    # None if unknown
+    if dstpath:
+        path = os.path.dirname(dstpath)
+        while not os.path.isdir(path):
+            path = os.path.dirname(path)
+        st = os.statvfs(path)
+        return st.f_bavail*st.f_frsize
+    # the backend reports every storage group directory in KiB
+    dirs = [sg.dirname.rstrip('/') for sg in
+            db.getStorageGroup(groupname='Videos', hostname=host)]
+    free = [(fs.totalspace - fs.usedspace)*1024 for fs in bend.getFreeSpace()
+            if fs.host == host and fs.path.rstrip('/') in dirs]
+    return max(free) if free else None
+
+def reservation_key(rec):
+    return '{}:{}:{:%Y%m%d%H%M%S}'.format(os.getpid(), *rec_key(rec))
+
+def space_left(entry):
+    # Bytes a reserved copy has still to write. Whatever it has already
+    # written to a local file is gone from statvfs' free space, so only the
+    # rest of it counts. Reservations made before the path was kept with
+    # them are a bare size.
+    need, dstpath = entry if isinstance(entry, list) else (entry, None)
+    try:
+        return max(need - os.path.getsize(dstpath), 0) if dstpath else need
+    except OSError:
+        return need
+
+def release_space(rec):
+    update_table('reservations',
+                 lambda table: table.pop(reservation_key(rec), None))
+
+def preflight(db, bend, host, vid, rec, opts, log):
+    # Reserve room for the copy and check it can finish in time. Returns
+    # None to go ahead, else the reason it cannot. Reservations of copies
+    # still running on this machine count against the free space, less what
+    # they have already written when the destination is local.
+    dstpath = find_local(db, host, 'Videos', vid.filename, new=True)
+    free = free_space(db, bend, host, dstpath)
+    entry = [rec.filesize, dstpath]
+    need = space_left(entry)
+
+    def reserve(table):
+        for key in list(table):
+            if not pid_alive(int(key.split(':')[0])):
+                del table[key]
+        if free is not None and need + SPACEMARGIN > \
+                free - sum(space_left(e) for e in table.values()):
+            return False
+        table[reservation_key(rec)] = entry
+        return True
+
+    if not update_table('reservations', reserve):
+        return 'Not enough space in Videos, {} MB needed, {} MB free'.format(
+                        need//2**20, free//2**20)
+
+    rate = update_table('rates', lambda table: table.get(devices(rec, host)[0]))
+    if rate:
+        estimate = int(need/rate)
+        log(log.GENERAL, log.INFO, 'Estimated transfer time',
+                        '{} seconds at {:.1f} MB/s'.format(estimate, rate/1e6))
+        if opts.maxtime and estimate > opts.maxtime:
+            release_space(rec)
+            return 'Estimated transfer time of {} seconds is over {}'.format(
+                        estimate, opts.maxtime)
+    return None
+
+def record_rate(rec, host, rate):
+    # Keep a smoothed transfer rate per source group for later estimates
+    def change(table):
+        key = devices(rec, host)[0]
+        old = table.get(key)
+        table[key] = rate if old is None else old + RATEWEIGHT*(rate - old)
+    update_table('rates', change)
+
+def read_into(fp, buf, size):
+    # Fill buf with up to size bytes, in place where the file object allows
+    view = memoryview(buf)
+    if not hasattr(fp, 'readinto'):
+        data = fp.read(size)
+        view[:len(data)] = data
+        return len(data)
+    done = 0
+    while done < size:
+        tsize = fp.readinto(view[done:size])
+        if not tsize:
+            break
+        done += tsize
+    return done
+
+def checkpoint_path(rec):
+    return os.path.join(STATEDIR, '{}_{:%Y%m%d%H%M%S}.checkpoint'
+                                  .format(*rec_key(rec)))
+
+def load_checkpoint(rec):
+    try:
+        with open(checkpoint_path(rec)) as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+def save_checkpoint(rec, info):
+    # replace in one step so a crash never leaves half a checkpoint
+    path = checkpoint_path(rec)
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(info, fp)
+    os.replace(path + '.tmp', path)
+
+def claim_destination(rec, filename):
+    # A checkpoint at 0 before the first byte is written, so a run that dies
+    # at any point leaves a transfer the next run redoes, never a partial
+    # file that dup_check() takes for a duplicate. It goes once the Video
+    # row is written, see drop_checkpoint().
+    os.makedirs(STATEDIR, exist_ok=True)
+    save_checkpoint(rec, {'filename':filename, 'size':rec.filesize, 'done':0,
+                          'chunklen':0, 'chunkhash':hashlib.blake2b(b'').hexdigest()})
+
+def drop_checkpoint(rec):
+    if os.path.exists(checkpoint_path(rec)):
+        os.remove(checkpoint_path(rec))
 
+def resume_point(rec, filename, dstpath):
+    # Bytes of dstpath known good from an interrupted run, 0 for none. The
+    # last checkpointed chunk is compared, rereading the whole prefix would
+    # cost as much as copying it again.
+    info = load_checkpoint(rec)
+    if not info or info['filename'] != filename or \
+       info['size'] != rec.filesize or not os.path.exists(dstpath) or \
+       os.path.getsize(dstpath) < info['done']:
+        return 0
+    with open(dstpath, 'rb') as fp:
+        fp.seek(info['done'] - info['chunklen'])
+        if hashlib.blake2b(fp.read(info['chunklen'])).hexdigest() != \
+           info['chunkhash']:
+            return 0
+    return info['done']
+
+def stream_copy(vid, rec, report, digest=False, dstpath=None, start=0):
+    # The reader thread fills buffers from the source while this thread
+    # writes the previous ones, the buffers are recycled, never reallocated.
+    # The source hash is computed by the reader as the bytes pass through.
+    # A local dstpath is written directly and checkpointed, so a later run
+    # can continue from start.
+    srcsize = rec.filesize
+    state = hash_init(srcsize, digest)
     srcfp = rec.open('r')
-    dstfp = vid.open('w')
+    if not dstpath:
+        dstfp = vid.open('w')
+    elif start:
+        dstfp = open(dstpath, 'r+b')
+        dstfp.truncate(start)
+        # the hashed parts already copied come off the local disk
+        if digest:
+            ranges = [(0, start)]
+        else:
+            tailstart = max(srcsize - HASHWINDOW, HASHWINDOW)
+            ranges = [(0, min(HASHWINDOW, start)), (tailstart, start)]
+        for offset, end in ranges:
+            dstfp.seek(offset)
+            while offset < end:
+                data = dstfp.read(min(CHUNK, end - offset))
+                hash_update(state, offset, data)
+                offset += len(data)
+        dstfp.seek(start)
+        srcfp.seek(start)
+    else:
+        os.makedirs(os.path.dirname(dstpath), exist_ok=True)
+        dstfp = open(dstpath, 'wb')
+
+    free = queue.Queue()
+    full = queue.Queue()
+    for i in range(BUFFERS):
+        free.put(bytearray(CHUNK))
+
+    def reader():
+        try:
+            done = start
+            while done < srcsize:
+                buf = free.get()
+                if buf is None:
+                    return
+                started = time.perf_counter()
+                tsize = read_into(srcfp, buf, min(CHUNK, srcsize - done))
+                if tsize == 0:
+                    raise IOError('Short read from {}'.format(rec.basename))
+                chunk_sample('read', started, tsize)
+                hash_update(state, done, memoryview(buf)[:tsize])
+                done += tsize
+                full.put((buf, tsize))
+            full.put((None, 0))
+        except Exception as e:
+            full.put((e, 0))
+
+    thread = threading.Thread(target=reader, name='reader', daemon=True)
+    thread.start()
+    try:
+        done = saved = start
+        while True:
+            buf, tsize = full.get()
+            if buf is None:
+                break
+            if isinstance(buf, Exception):
+                raise buf
+            started = time.perf_counter()
+            dstfp.write(memoryview(buf)[:tsize])
+            chunk_sample('write', started, tsize)
+            done += tsize
+            if dstpath and done - saved >= CHECKPOINT:
+                dstfp.flush()
+                os.fsync(dstfp.fileno())
+                save_checkpoint(rec, {'filename':vid.filename, 'size':srcsize,
+                        'done':done, 'chunklen':tsize,
+                        'chunkhash':hashlib.blake2b(memoryview(buf)[:tsize]).hexdigest()})
+                saved = done
+            free.put(buf)
+            report(done, srcsize)
+    finally:
+        # release the reader if the write side failed
+        free.put(None)
+        thread.join()
+        srcfp.close()
+        dstfp.close()
+    return state
+
+def progress_init(thisJob, interval, pctstep):
+    # Job comments are database writes, so they are only made every interval
+    # seconds or pctstep percent, whichever comes first
+    now = time.time()
+    return {'job':thisJob, 'interval':interval, 'pctstep':pctstep,
+            'start':now, 'time':now, 'done':0, 'rate':None,
+            'posted':now, 'pct':0.0}
+
+def progress_update(state, done, total):
+    # Smooth the rate over every sample, post only when a threshold passes
+    now = time.time()
+    if now > state['time']:
+        sample = (done - state['done'])/(now - state['time'])
+        if state['rate'] is None:
+            state['rate'] = sample
+        else:
+            state['rate'] += RATEWEIGHT*(sample - state['rate'])
+    state['time'] = now
+    state['done'] = done
+
+    pct = done*100.0/total if total else 100.0
+    if not state['job'] or not state['rate']:
+        return
+    if now - state['posted'] < state['interval'] and \
+       pct - state['pct'] < state['pctstep']:
+        return
+    state['posted'] = now
+    state['pct'] = pct
+    state['job'].setComment("{:.2f}% complete - {} seconds remaining".format\
+                              (pct, int((total-done)/state['rate'])))
+
+def chunk_sample(kind, started, size):
+    # Keep the time of one copy block when --profile samples them
+    chunks = PROFILE['chunks']
+    if chunks is not None and len(chunks) < PROFILESAMPLES:
+        chunks.append((kind, time.perf_counter() - started, size))
+
+def profile_start(kinds):
+    # Turn on the collectors named in --profile: cpu, memory, chunks or all
+    kinds = set(kinds.split(','))
+    if 'all' in kinds:
+        kinds = {'cpu', 'memory', 'chunks'}
+    unknown = kinds - {'cpu', 'memory', 'chunks'}
+    if unknown:
+        raise ValueError('Unknown --profile kinds: ' + ','.join(sorted(unknown)))
+    if 'cpu' in kinds:
+        PROFILE['cpu'] = True
+        profiler = cProfile.Profile()
+        PROFILE['profilers'].append(profiler)
+        profiler.enable()
+    if 'memory' in kinds:
+        tracemalloc.start(PROFILETOP)
+    if 'chunks' in kinds:
+        PROFILE['chunks'] = []
+
+@contextmanager
+def profile_thread():
+    # Profile a batch worker. Before 3.12 cProfile only sees the thread that
+    # enabled it, from 3.12 the main profiler sees every thread and only one
+    # may be enabled. A worker that cannot have its own goes unprofiled.
+    if not PROFILE['cpu'] or sys.version_info >= (3, 12) or \
+       threading.current_thread() is threading.main_thread():
+        yield
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        yield
+        return
+    PROFILE['profilers'].append(profiler)
+    try:
+        yield
+    finally:
+        profiler.disable()
+
+def chunk_summary(chunks):
+    # Percentiles of the block times and the rate, per kind of block
+    summary = {}
+    for kind in sorted(set(kind for kind, seconds, size in chunks)):
+        times = sorted(seconds for each, seconds, size in chunks if each == kind)
+        nbytes = sum(size for each, seconds, size in chunks if each == kind)
+        pick = lambda pct: times[min(len(times) - 1, int(len(times)*pct/100))]
+        summary[kind] = {'count':len(times), 'p50':pick(50), 'p90':pick(90),
+                         'p99':pick(99), 'max':times[-1],
+                         'mbps':nbytes/max(sum(times), 1e-9)/1e6}
+    return summary
+
+def profile_stop(stem, log):
+    # Write what was collected next to the log file: stem.prof for pstats
+    # or snakeviz, stem.tracemalloc for tracemalloc.Snapshot.load() and
+    # stem.chunks.json with the copy block times
+    if PROFILE['profilers']:
+        PROFILE['profilers'][0].disable()
+    profilers = [profiler for profiler in PROFILE['profilers'] if profiler.getstats()]
+    if profilers:
+        stats = pstats.Stats(*profilers)
+        stats.dump_stats(stem + '.prof')
+        log(log.GENERAL, log.INFO, 'CPU profile written', stem + '.prof')
+    if tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        snapshot.dump(stem + '.tracemalloc')
+        for stat in snapshot.statistics('lineno')[:PROFILETOP]:
+            log(log.GENERAL, log.INFO, 'Allocated', str(stat))
+        log(log.GENERAL, log.INFO, 'Memory snapshot written', stem + '.tracemalloc')
+    if PROFILE['chunks']:
+        summary = chunk_summary(PROFILE['chunks'])
+        with open(stem + '.chunks.json', 'w') as fp:
+            json.dump({'summary':summary, 'samples':PROFILE['chunks']}, fp)
+        for kind, stat in summary.items():
+            log(log.GENERAL, log.INFO, 'Copy blocks, {}'.format(kind),
+                '{count} blocks, p50 {p50:.4f} s, p90 {p90:.4f} s, p99 {p99:.4f} s, '
+                'max {max:.4f} s, {mbps:.1f} MB/s'.format(**stat))
+
+def startup_seconds():
+    # Seconds since the process started, interpreter and imports included,
+    # read from /proc where there is one
+    try:
+        with open('/proc/self/stat') as fp:
+            ticks = int(fp.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as fp:
+            uptime = float(fp.read().split()[0])
+        return max(uptime - ticks/os.sysconf('SC_CLK_TCK'), 0)
+    except (OSError, ValueError, IndexError):
+        return time.time() - STARTED
+
+def metrics_init(jobid):
+    # The timing of one migration, filled by span() and written out by
+    # metrics_finish(). calls counts the backend requests made so far.
+    return {'job':jobid, 'start':time.time(), 'calls':0, 'phases':[]}
+
+@contextmanager
+def span(metrics, name):
+    # Time a phase of a migration into metrics, also when it raises. The
+    # caller may set 'bytes' and 'rows' on the yielded record.
+    record = {'phase':name, 'bytes':0, 'rows':0}
+    calls = metrics['calls']
+    start = time.time()
+    try:
+        yield record
+    finally:
+        record['seconds'] = round(time.time() - start, 6)
+        record['calls'] = metrics['calls'] - calls
+        metrics['phases'].append(record)
+
+class LazyBackend(object):
+    # A MythBE that connects on the first request, many runs never make one
+    def __init__(self, db):
+        self._db = db
+        self._bend = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        with self._lock:
+            if self._bend is None:
+                self._bend = MythBE(db=self._db)
+        return getattr(self._bend, name)
+
+class Counted(object):
+    # A MythBE whose requests are counted in metrics['calls']
+    def __init__(self, bend, metrics):
+        self._bend = bend
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._bend, name)
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            self._metrics['calls'] += 1
+            return attr(*args, **kwargs)
+        return call
+
+def prom_totals(table, metrics):
+    # Fold one migration into the running totals kept for --promfile
+    phases = table.setdefault('phases', {})
+    for record in metrics['phases']:
+        total = phases.setdefault(record['phase'],
+                    {'runs':0, 'seconds':0, 'bytes':0, 'rows':0, 'calls':0})
+        for field in ('seconds', 'bytes', 'rows', 'calls'):
+            total[field] += record[field]
+        total['seconds'] = round(total['seconds'], 6)
+        total['runs'] += 1
+        total['last'] = record['seconds']
+    jobs = table.setdefault('jobs', {})
+    jobs[metrics['status']] = jobs.get(metrics['status'], 0) + 1
+    table['lastjob'] = metrics['end']
+    table['lastseconds'] = metrics['seconds']
+
+def prom_text(table):
+    # The totals in the Prometheus text format
+    lines = []
+    def metric(name, kind, helptext, samples):
+        name = '{}_{}'.format(PROMPREFIX, name)
+        lines.append('# HELP {} {}'.format(name, helptext))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for labels, value in samples:
+            lines.append('{}{} {}'.format(name, labels, value))
+
+    phases = sorted(table['phases'].items())
+    for field, kind, helptext in (
+            ('runs', 'counter', 'Times a migration phase ran.'),
+            ('seconds', 'counter', 'Seconds spent in a migration phase.'),
+            ('bytes', 'counter', 'Bytes moved by a migration phase.'),
+            ('rows', 'counter', 'Database rows copied by a migration phase.'),
+            ('calls', 'counter', 'Backend requests made by a migration phase.')):
+        metric('phase_{}_total'.format(field), kind, helptext,
+               [('{{phase="{}"}}'.format(name), total[field])
+                for name, total in phases])
+    metric('phase_last_seconds', 'gauge',
+           'Seconds the phase took in the last migration that ran it.',
+           [('{{phase="{}"}}'.format(name), total['last'])
+            for name, total in phases])
+    metric('jobs_total', 'counter', 'Migrations by outcome.',
+           [('{{status="{}"}}'.format(status), count)
+            for status, count in sorted(table['jobs'].items())])
+    metric('last_job_timestamp_seconds', 'gauge',
+           'When the last migration ended.', [('', table['lastjob'])])
+    metric('last_job_seconds', 'gauge',
+           'Seconds the last migration took.', [('', table['lastseconds'])])
+    return '\n'.join(lines) + '\n'
+
+def metrics_finish(metrics, status, opts):
+    # Append the migration as one JSON line to --metrics and add it to the
+    # totals in --promfile. Both are shared by every run on this machine.
+    metrics['end'] = time.time()
+    metrics['status'] = status
+    metrics['seconds'] = round(metrics['end'] - metrics['start'], 6)
+    if opts.metrics:
+        line = {'time':datetime.fromtimestamp(metrics['end'], timezone.utc).isoformat()}
+        line.update((key, value) for key, value in metrics.items()
+                    if key not in ('start', 'end', 'calls'))
+        with open(opts.metrics, 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            fp.write(json.dumps(line, default=str) + '\n')
+    if opts.promfile:
+        def change(table):
+            prom_totals(table, metrics)
+            # the collector must never see half a file
+            with open(opts.promfile + '.tmp', 'w') as fp:
+                fp.write(prom_text(table))
+            os.replace(opts.promfile + '.tmp', opts.promfile)
+        update_table('metrics', change)
+
+def copy(vid, rec, thisJob, log, db, host, opts):
+    stime = time.time()
+    progress = progress_init(thisJob, opts.interval, opts.pctstep)
+
+    def report(done, srcsize):
+        progress_update(progress, done, srcsize)
 
     if thisJob:
         thisJob.setStatus(Job.RUNNING)
-    tsize = 2**24
-    while tsize == 2**24:
-        tsize = min(tsize, srcsize - dstfp.tell())
-        dstfp.write(srcfp.read(tsize))
-        htime.append(time.time())
-        rate = float(tsize*4)/(time.time()-htime.pop(0))
-        remt = (srcsize-dstfp.tell())/rate
-        if thisJob:
-            thisJob.setComment("%{:.2%}% complete - {} seconds remaining".format\
-                                  (dstfp.tell()*100/srcsize, remt))
-    srcfp.close()
-    dstfp.close()
-    
-    vid.hash = vid.getHash()
+
+    # take the short way when both ends are on disks of this machine
+    srcpath = find_local(db, rec.hostname, rec.storagegroup, rec.basename)
+    dstpath = find_local(db, host, 'Videos', vid.filename, new=True)
+    start = 0
+    if dstpath and not srcpath:
+        start = resume_point(rec, vid.filename, dstpath)
+    if not start:
+        claim_destination(rec, vid.filename)
+    if srcpath and dstpath:
+        log(log.GENERAL|log.FILE, log.INFO, "Local transfer",
+                            "{} to {}".format(srcpath, dstpath))
+        method, srcstate, dststate = local_copy(srcpath, dstpath, report,
+                                                opts.digest)
+        dsthash = hash_final(dststate)
+    else:
+        method = 'myth://'
+        if start:
+            log(log.GENERAL|log.FILE, log.INFO, "Resuming transfer",
+                            "{} of {} bytes already copied".format(start, rec.filesize))
+            progress['done'] = start
+        srcstate = dststate = stream_copy(vid, rec, report, opts.digest,
+                                          dstpath, start)
+        dsthash = None
+
+    srchash = hash_final(srcstate)
+    vid.hash = srchash
     
+    elapsed = time.time()-stime
+    rate = (progress['done'] - start)/max(elapsed, 1e-3)/1e6
+    if method != 'reflink':
+        record_rate(rec, host, rate*1e6)
     log(log.GENERAL|log.FILE, log.INFO, "Transfer Complete",
-    			      "{} seconds elapsed".format(int(time.time()-stime)))
+    			      "{} seconds elapsed using {}, {:.1f} MB/s".format(int(elapsed),
+                                                   method, rate))
+    if dststate['digest']:
+        log(log.GENERAL|log.FILE, log.INFO, "BLAKE2 digest",
+                            dststate['digest'].hexdigest())
 
     if thisJob:
         thisJob.setComment("Complete - {} seconds elapsed".
-                           format(int(time.time()-stime)))
+                           format(int(elapsed)))
+    return srchash, dsthash
+
+def rec_key(rec):
+    # chanid and starttime as stored in the recorded tables, UTC and naive
+    return (rec.chanid,
+            rec.starttime.astimezone(timezone.utc).replace(tzinfo=None))
+
+def fetch_rows(db, query, args):
+    # Yield the rows of query ROWBATCH at a time
+    with db as cursor:
+        cursor.execute(query, args)
+        while True:
+            rows = cursor.fetchmany(ROWBATCH)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+def insert_markup(db, filename, rows):
+    # Write (mark, offset, type) rows to filemarkup for filename, ROWBATCH
+    # rows per statement, all in one transaction. rows may be a generator.
+    # Returns the row count.
+    def flush(cursor, batch):
+        args = []
+        for mark, offset, mtype in batch:
+            args += [filename, mark, offset, mtype]
+        cursor.execute("""INSERT INTO filemarkup
+                          (filename, mark, offset, type) VALUES """ +
+                       ','.join(['(%s,%s,%s,%s)']*len(batch)), args)
+        return len(batch)
+
+    count = 0
+    batch = []
+    with db as cursor:
+        cursor.execute('START TRANSACTION')
+        try:
+            for row in rows:
+                batch.append(row)
+                if len(batch) == ROWBATCH:
+                    count += flush(cursor, batch)
+                    batch = []
+            if batch:
+                count += flush(cursor, batch)
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+    return count
 
-def copy_markup(vid, rec, start, stop):
-    for mark in rec.markup:
-        if mark.type in (start, stop):
-            vid.markup.add(mark.mark, 0, mark.type)
+def copy_seek(vid, rec, db):
+    rows = fetch_rows(db, """SELECT mark, offset, type FROM recordedseek
+                             WHERE chanid=%s AND starttime=%s""", rec_key(rec))
+    return insert_markup(db, vid.filename, rows)
 
-def check_hash(vid, rec, bend):
-    srchash = bend.getHash(rec.basename, rec.storagegroup)
-    dsthash = bend.getHash(vid.filename, 'Videos')
+def copy_markup(vid, rec, db, types):
+    # Copy the markup of the given types, the database does the filtering
+    types = list(types)
+    rows = fetch_rows(db, """SELECT mark, 0, type FROM recordedmarkup
+                             WHERE chanid=%s AND starttime=%s
+                             AND type IN ({})""".format(','.join(['%s']*len(types))),
+                      list(rec_key(rec)) + types)
+    return insert_markup(db, vid.filename, rows)
+
+def check_hash(vid, bend, srchash, dsthash=None):
+    # srchash was taken during the copy, only a destination that was not
+    # hashed locally needs the backend
+    if dsthash is None:
+        dsthash = bend.getHash(vid.filename, 'Videos')
     if srchash != dsthash:
         return False
     else:
         return True
 
 def main():
-    jobid = 'MANUAL'
-    chanID = ''
-    startTime = ''
-    db = MythDB()
-    # host = db.dbconfig.hostname
     thisModule = 'Myth-Rec-to-Vid-v3.py'
-    host = db.gethostname()
-    bend = MythBE(db=db)
 
     # Capture the command line args
     parser = OptionParser(usage="usage: %prog [jobid] [options]")
@@ -180,6 +1192,22 @@ def main():
             help='If other data is copied and a failure occurs this will abort the whole process.')
     actiongroup.add_option("--delete", action="store_true", default=False,
             help="Delete source recording after successful export. Enforces use of --safe.")
+    # no longer used, a reflink gives the same saving without sharing the
+    # inode, still accepted so existing user job commands keep working
+    actiongroup.add_option("--hardlink", action="store_true", default=False, dest="hardlink",
+            help=SUPPRESS_HELP)
+    actiongroup.add_option("--digest", action="store_true", default=False, dest="digest",
+            help="Also log a BLAKE2 digest of the whole file, computed during the copy.")
+    actiongroup.add_option("--perdevice", action="store", type="int", default=2, dest="perdevice",
+            help="Most copies reading or writing one storage group at the same time, counting "+\
+                 "every migration on this machine, default 2.")
+    actiongroup.add_option("--maxtime", action="store", type="int", dest="maxtime",
+            help="Reject the migration if earlier transfers from the same storage group "+\
+                 "estimate it to take longer than this many seconds.")
+    actiongroup.add_option("--interval", action="store", type="int", default=30, dest="interval",
+            help="Seconds between job progress updates, default 30.")
+    actiongroup.add_option("--pctstep", action="store", type="float", default=10, dest="pctstep",
+            help="Percent of the copy between job progress updates, default 10.")
     parser.add_option_group(actiongroup)
 
     othergroup = OptionGroup(parser, "Other Data",
@@ -192,19 +1220,88 @@ def main():
             help="Copy manual commercial cuts from source recording.")
     parser.add_option_group(othergroup)
 
+    batchgroup = OptionGroup(parser, "Batch Migration",
+                    "These options migrate every recording matching the filters in one process "+\
+                    "in place of the job id. Filters combine with AND.")
+    batchgroup.add_option("--batch", action="store_true", default=False, dest="batch",
+            help="Migrate all recordings matching the filters below.")
+    batchgroup.add_option("--title", action="store", type="string", dest="title",
+            help="Only recordings with this title.")
+    batchgroup.add_option("--recgroup", action="store", type="string", dest="recgroup",
+            help="Only recordings in this recording group.")
+    batchgroup.add_option("--after", action="store", type="string", dest="after",
+            help="Only recordings starting at or after this time, format is year-mm-dd [hh:mm:ss] in UTC")
+    batchgroup.add_option("--before", action="store", type="string", dest="before",
+            help="Only recordings starting before this time, format is year-mm-dd [hh:mm:ss] in UTC")
+    batchgroup.add_option("--recording", action="append", type="string", dest="recording",
+            help="A recording to include, format is chanid,year-mm-dd hh:mm:ss in UTC. May be repeated.")
+    batchgroup.add_option("--workers", action="store", type="int", default=2, dest="workers",
+            help="Number of recordings migrated at the same time, default 2.")
+    parser.add_option_group(batchgroup)
+
+    daemongroup = OptionGroup(parser, "Daemon",
+                    "These options keep one process running that claims the queued user jobs "+\
+                    "for this script from the jobqueue, so each job skips the start up and "+\
+                    "shares the connections and video index. Jobs run with the options given "+\
+                    "here, not the arguments of the user job command. Turn off 'Allow User Job' "+\
+                    "for the job on the backends so they do not start it as well.")
+    daemongroup.add_option("--daemon", action="store_true", default=False, dest="daemon",
+            help="Run queued jobs until stopped with SIGTERM or SIGINT, --workers at a time.")
+    daemongroup.add_option("--userjob", action="store", type="int", dest="userjob",
+            help="User job number (1-4) to claim, default the ones whose command runs "+\
+                 "this script.")
+    daemongroup.add_option("--poll", action="store", type="int", default=POLLWAIT, dest="poll",
+            help="Seconds between looks at the jobqueue when idle, default {}.".format(POLLWAIT))
+    parser.add_option_group(daemongroup)
+
+    measuregroup = OptionGroup(parser, "Measurements",
+                    "These options record how long each phase of a migration takes.")
+    measuregroup.add_option("--metrics", action="store", type="string", dest="metrics",
+            help="Append a JSON line with the time, bytes, rows and backend requests of each "+\
+                 "phase of every migration to this file.")
+    measuregroup.add_option("--promfile", action="store", type="string", dest="promfile",
+            help="Keep running totals per phase in this file for the Prometheus node "+\
+                 "exporter textfile collector, the name must end in .prom")
+    measuregroup.add_option("--profile", action="store", type="string", dest="profile",
+            help="Profile the run, a comma separated list of cpu (cProfile, a .prof file "+\
+                 "for snakeviz), memory (a tracemalloc snapshot), chunks (the time of "+\
+                 "every copy block) or all. Written next to the log file in --logpath, "+\
+                 "else to the working directory.")
+    parser.add_option_group(measuregroup)
+
     MythLog.loadOptParse(parser)
     opts, args = parser.parse_args()
 
+    # nothing to do, say so before connecting to anything
+    manual = opts.chanid and opts.startdate and opts.starttime and opts.offset
+    if not (opts.batch or opts.daemon or manual or args):
+        parser.print_help()
+        sys.exit(0)
+
+    # the backend is only connected when a phase first needs it
+    db = MythDB()
+    # host = db.dbconfig.hostname
+    host = db.gethostname()
+    bend = LazyBackend(db)
+
+    # the log file, and the profile beside it, are named from stem
+    stem = os.path.join(opts.logpath or '', '{0}.{1}.{2}'.format(thisModule,
+                                    datetime.now().strftime('%Y%m%d%H%M%S'),
+                                    os.getpid()))
     try:
         log = MythLog(module=thisModule, db=db)
         if opts.logpath:
-            log._setfile('{0}/{1}.{2}.{3}.log'.format(opts.logpath,
-                                    thisModule,
-                                    datetime.now().strftime('%Y%m%d%H%M%S'),
-                                    os.getpid()))
+            log._setfile(stem + '.log')
     except Exception as e:
         log.logTB(log.GENERAL)
 
+    if opts.profile:
+        try:
+            profile_start(opts.profile)
+        except ValueError as e:
+            parser.error(str(e))
+        atexit.register(profile_stop, stem, log)
+
     if opts.verbose:
         if opts.verbose == 'help':
             print (log.helptext)
@@ -214,52 +1311,268 @@ def main():
     if opts.delete:
         opts.safe = True
 
+    if opts.hardlink:
+        log(log.GENERAL, log.INFO, '--hardlink is ignored',
+                        'a reflink is used where the filesystem supports it')
+
+    # a daemon runs the jobs it claims until stopped
+    if opts.daemon:
+        try:
+            daemon(opts, db, bend, host, log)
+        except Exception as e:
+            log(log.GENERAL|log.FILE, log.INFO, "ERROR in Daemon",
+        			      "Message was: {}".format(e))
+            sys.exit(1)
+        sys.exit(0)
+
+    # a batch runs on its own and never has a job id
+    elif opts.batch:
+        try:
+            ok = batch(opts, db, bend, host, log)
+        except Exception as e:
+            log(log.GENERAL|log.FILE, log.INFO, "ERROR in Batch",
+        			      "Message was: {}".format(e))
+            sys.exit(1)
+        sys.exit(0 if ok else 1)
+
     # if a manual channel and time entry then setup the export with opts
-    if opts.chanid and opts.startdate and opts.starttime and opts.offset:
+    elif manual:
         try:
             chanID = opts.chanid
             startTime = opts.startdate + " " + opts.starttime + opts.offset
 
         except Exception as e:
             log.logTB("ERROR Processing fileName",
-    			      "Message was: {0}".format(e.message))
+    			      "Message was: {0}".format(e))
             sys.exit(1)
+        status = migrate_recording(chanID, startTime, opts, db, bend, host, log)
 
     # If an auto or manual job entry then setup the export with the jobID
-    elif len(args) >= 1:
-        try:
-            jobid = int(args[0])
-            thisJob = Job(jobid)
-            chanID = thisJob['chanid']
-            startTime = thisJob['starttime']
-            thisJob.update(status=Job.STARTING)
+    else:
+        status = migrate_job(int(args[0]), opts, db, bend, host, log)
 
-        except Exception as e:
-            Job(jobid).update({'status':Job.ERRORED,
-                                      'comment':'ERROR: ' + e})
-            log.logTB(log.GENERAL, log.INFO, "ERROR Processing fileName",
-    			      "Message was: {0}".format(e.message))
-            sys.exit(0)
+    if status == 'failed':
+        sys.exit(1)
 
-    # else bomb the job and return an error code
-    else:
-        parser.print_help()
-        sys.exit(0)
+def migrate_job(jobid, opts, db, bend, host, log, started=None):
+    # Run a queued job the way a process started for it by the backend does,
+    # returns the migrate() status or None when the job could not be read
+    try:
+        thisJob = Job(jobid, db=db)
+        chanID = thisJob['chanid']
+        startTime = thisJob['starttime']
+        thisJob.update(status=Job.STARTING)
+
+    except Exception as e:
+        Job(jobid, db=db).update({'status':Job.ERRORED,
+                                  'comment':'ERROR: ' + str(e)})
+        log.logTB(log.GENERAL, log.INFO, "ERROR Processing fileName",
+    			      "Message was: {0}".format(e))
+        return None
+
+    return migrate_recording(chanID, startTime, opts, db, bend, host, log,
+                             jobid, thisJob, started)
 
+def migrate_recording(chanID, startTime, opts, db, bend, host, log,
+                      jobid='MANUAL', thisJob=None, started=None):
+    # Look up and migrate one recording. The startup is the time since the
+    # process began, or since started when a daemon claimed the job.
     log(log.GENERAL, log.INFO, 'Recorording info', 
                     'JobID -  {}, ChanID - {}, StartTime - {}'.format(jobid,
                                  chanID, 
                                  startTime))
 
     # get the desired recording from Myth as an 'Object' and log it
-    rec = Recorded((chanID,startTime), db=db)
+    metrics = metrics_init(jobid)
+    metrics['startup'] = round(time.time() - started if started
+                               else startup_seconds(), 6)
+    log(log.GENERAL, log.INFO, 'Startup time',
+                    '{:.3f} seconds'.format(metrics['startup']))
+    with span(metrics, 'lookup'):
+        rec = Recorded((chanID,startTime), db=db)
+    return migrate(rec, opts, db, bend, host, log, thisJob, metrics)
+
+def find_recordings(db, opts):
+    # Build the batch from the filter options with one query on the keys
+    where = []
+    args = []
+    if opts.title:
+        where.append('title=%s')
+        args.append(opts.title)
+    if opts.recgroup:
+        where.append('recgroup=%s')
+        args.append(opts.recgroup)
+    if opts.after:
+        where.append('starttime>=%s')
+        args.append(opts.after)
+    if opts.before:
+        where.append('starttime<%s')
+        args.append(opts.before)
+    if opts.recording:
+        pairs = []
+        for item in opts.recording:
+            chanid, starttime = item.split(',', 1)
+            pairs.append('(chanid=%s AND starttime=%s)')
+            args += [int(chanid), starttime.strip()]
+        where.append('(' + ' OR '.join(pairs) + ')')
+    if not where:
+        raise ValueError('A batch needs at least one filter')
+
+    with db as cursor:
+        cursor.execute("""SELECT chanid, starttime FROM recorded
+                          WHERE {} ORDER BY starttime"""
+                          .format(' AND '.join(where)), args)
+        keys = cursor.fetchall()
+    # the database holds UTC, say so like the manual --offset does
+    return [Recorded((chanid, '{:%Y-%m-%d %H:%M:%S}+00:00'.format(starttime)),
+                     db=db) for chanid, starttime in keys]
+
+def batch(opts, db, bend, host, log):
+    # Migrate every recording matching the filters on the shared connections
+    recs = find_recordings(db, opts)
+    log(log.GENERAL, log.INFO, 'Batch migration',
+                    '{} recordings, {} workers'.format(len(recs), opts.workers))
+
+    def run(rec):
+        try:
+            with profile_thread():
+                status = migrate(rec, opts, db, bend, host, log)
+        except Exception as e:
+            log.logTB(log.GENERAL)
+            status = 'failed'
+        log(log.GENERAL|log.FILE, log.INFO, 'Batch item {}'.format(status),
+                    '{} - {}'.format(rec['title'], rec['subtitle']))
+        return status
+
+    results = schedule(recs, host, opts.workers, opts.perdevice, run)
+
+    counts = dict((status, results.count(status))
+                  for status in ('migrated', 'duplicate', 'rejected', 'failed'))
+    log(log.GENERAL|log.FILE, log.INFO, 'Batch Complete',
+                    '{migrated} migrated, {duplicate} duplicates, '
+                    '{rejected} rejected, {failed} failed'.format(**counts))
+    return counts['failed'] == 0
+
+def user_job_types(db, userjob=None):
+    # The job types to claim, userjob if given, else every UserJobN setting
+    # whose command runs this script. UserJob1 is Job.USERJOB1 and so on.
+    if userjob:
+        numbers = [userjob]
+    else:
+        with db as cursor:
+            cursor.execute("""SELECT value FROM settings
+                              WHERE value LIKE %s AND data LIKE %s""",
+                           ('UserJob_', '%' + os.path.basename(__file__) + '%'))
+            numbers = sorted(set(int(value[-1]) for value, in cursor.fetchall()
+                                 if value[-1].isdigit()))
+    if not numbers or not all(1 <= n <= 4 for n in numbers):
+        raise ValueError('No user job runs {}, give --userjob'.format(
+                                    os.path.basename(__file__)))
+    return [Job.USERJOB1 << (n - 1) for n in numbers]
+
+def claim_job(db, types, host):
+    # Take the oldest queued job of these types meant for this host or any
+    # host, returns its id or None. A job is taken by an UPDATE that only
+    # matches while it is still QUEUED, so whatever the table engine only
+    # one daemon gets it. One that loses the race tries the next job.
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    with db as cursor:
+        cursor.execute("""SELECT id FROM jobqueue
+                          WHERE type IN ({}) AND status=%s
+                            AND (hostname='' OR hostname=%s)
+                            AND schedruntime<=%s
+                          ORDER BY schedruntime, id LIMIT %s"""
+                       .format(','.join(['%s']*len(types))),
+                       list(types) + [Job.QUEUED, host, now, CLAIMBATCH])
+        for (jobid,) in cursor.fetchall():
+            cursor.execute("""UPDATE jobqueue
+                              SET status=%s, hostname=%s, statustime=%s
+                              WHERE id=%s AND status=%s
+                                AND (hostname='' OR hostname=%s)""",
+                           (Job.STARTING, host, now, jobid, Job.QUEUED, host))
+            if cursor.rowcount == 1:
+                return jobid
+    return None
+
+def daemon(opts, db, bend, host, log):
+    # Claim and run queued jobs, at most --workers at a time, on the shared
+    # connections and index until SIGTERM or SIGINT. The claims use their
+    # own connection so they never wait behind a migration's queries.
+    types = user_job_types(db, opts.userjob)
+    claimdb = MythDB()
+    log(log.GENERAL|log.FILE, log.INFO, 'Daemon started',
+                    'Job types {}, {} workers'.format(
+                        ', '.join(str(t) for t in types), opts.workers))
+
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: stop.set())
+    slots = threading.BoundedSemaphore(opts.workers)
+    running = []
+
+    def run(jobid, started):
+        try:
+            with profile_thread():
+                status = migrate_job(jobid, opts, db, bend, host, log,
+                                     started) or 'failed'
+        except Exception as e:
+            log.logTB(log.GENERAL)
+            Job(jobid, db=db).update({'status':Job.ERRORED,
+                                      'comment':'ERROR: ' + str(e)})
+            status = 'failed'
+        finally:
+            slots.release()
+        log(log.GENERAL|log.FILE, log.INFO, 'Job {} {}'.format(jobid, status), '')
+
+    while not stop.is_set():
+        if not slots.acquire(timeout=1):
+            continue
+        try:
+            jobid = claim_job(claimdb, types, host)
+        except Exception as e:
+            log(log.GENERAL|log.FILE, log.INFO, "ERROR claiming a job",
+                            "Message was: {}".format(e))
+            jobid = None
+        if jobid is None:
+            slots.release()
+            stop.wait(opts.poll)
+            continue
+        log(log.GENERAL, log.INFO, 'Claimed job', str(jobid))
+        worker = threading.Thread(target=run, args=(jobid, time.time()),
+                                  name='job{}'.format(jobid))
+        worker.start()
+        running = [t for t in running if t.is_alive()] + [worker]
+
+    running = [t for t in running if t.is_alive()]
+    log(log.GENERAL|log.FILE, log.INFO, 'Daemon stopping',
+                    'Waiting for {} jobs'.format(len(running)))
+    for worker in running:
+        worker.join()
+
+def migrate(rec, opts, db, bend, host, log, thisJob=None, metrics=None):
+    # Migrate one recording, returns 'migrated', 'duplicate', 'rejected'
+    # or 'failed'. Each phase is timed, see metrics_finish().
+    if metrics is None:
+        metrics = metrics_init(thisJob['id'] if thisJob else 'BATCH')
+    metrics['chanid'], metrics['starttime'] = rec_key(rec)
+    metrics['title'] = rec['title']
+    status = 'failed'
+    try:
+        status = migrate_phases(rec, opts, db, Counted(bend, metrics), host,
+                                log, thisJob, metrics)
+    finally:
+        metrics_finish(metrics, status, opts)
+    return status
+
+def migrate_phases(rec, opts, db, bend, host, log, thisJob, metrics):
     log(log.GENERAL, log.INFO, 'Using recording',
                     '{} - {}'.format(rec['title'], 
                                  rec['subtitle']))
 
-    # get a blank video object from myth
-    vid = Video(db=db).create({'title':u'', 'filename':u'',
-                                         'host':host})
+    # a video object for the new file, its row is only written once the
+    # copy has been verified, so a duplicate or failure costs no INSERT
+    vid = Video(db=db)
+    vid['host'] = host
 
     # determien the time of recording
     thisType = getType(rec)
@@ -270,36 +1583,42 @@ def main():
         # create a file name without a lot of BS
         ext = rec.basename.rsplit('.',1)[1]
         if(thisType == 'TV'):
-            # as in 'Television/%TITLE%/Season %SEASON%/'+\
-            #            '%TITLE% - S%SEASON%E%EPISODEPAD% - %SUBTITLE%'
-            fileName = 'Television/{0}/Season {1}/{2} - S{3}E{4} - {5}.{6}'.format(
-                    rec['title'],
-                    rec['season'],
-                    rec['title'],
-                    rec['season'],
-                    rec['episode'],
-                    rec['subtitle'],
-                    ext)
+            fileName = render_fmt(TVFMT, recording_fields(rec)) + '.' + ext
             vid['contenttype'] = 'TELEVISION'
         else:
-            # as in 'Movies/%TITLE%'
-            fileName = 'Movies/{0}.{1}'.format(rec['title'],
-                                               ext)
+            fileName = render_fmt(MVFMT, recording_fields(rec)) + '.' + ext
             vid['contenttype'] = 'MOVIE'
         # set the file name in the video object    
         vid['filename'] = fileName
     
     except Exception as e:
         log(log.GENERAL|log.FILE, log.INFO, "ERROR Processing fileName",
-    			      "Message was: {0}".format(e.message))
-        error_out(vid, thisJob)
+    			      "Message was: {0}".format(e))
+        return error_out(vid, thisJob)
 
-    # make sure you are not creating a duplicate
-    if (dup_check(vid, rec, thisJob, bend, log)):
-        vid.delete()
+    # make sure you are not creating a duplicate, the file left by an
+    # interrupted run of this recording is not one
+    ckpt = load_checkpoint(rec)
+    resuming = ckpt and ckpt['filename'] == vid['filename']
+    if resuming:
+        log(log.GENERAL, log.INFO, 'Found an interrupted transfer of ',
+                    '{0}'.format(vid['filename']))
+    with span(metrics, 'dup_check'):
+        duplicate = not resuming and dup_check(vid, rec, thisJob, bend, log, db)
+    if duplicate:
         if thisJob:
             thisJob.setStatus(Job.FINISHED)
-        sys.exit(0)
+        return 'duplicate'
+
+    # refuse now what would fail or overrun later
+    with span(metrics, 'preflight'):
+        reason = preflight(db, bend, host, vid, rec, opts, log)
+    if reason:
+        log(log.GENERAL|log.FILE, log.INFO, "Migration rejected", reason)
+        index_release(vid['filename'])
+        if thisJob:
+            thisJob.update({'status':Job.ERRORED, 'comment':reason})
+        return 'rejected'
 
     else:
         try:
@@ -308,67 +1627,99 @@ def main():
                                                 +" to myth://Videos@{}/{}"
                                                 .format(host, vid['filename']))
 
-            # I certainly hope the grabber is working and I do not need to
-            # grab it again. If you have issues or missing data
-            # see fix_metadata.py
-            copy(vid, rec, thisJob, log)
-            mdata = rec.exportMetadata()
-            vid.importMetadata(mdata)
-            vid.update()
+            # wait out other migrations using the same disks
+            with ExitStack() as slots:
+                with span(metrics, 'slot_wait'):
+                    if thisJob:
+                        thisJob.setComment("Waiting for a transfer slot")
+                    slots.enter_context(device_slots(devices(rec, host),
+                                                     opts.perdevice))
+                with span(metrics, 'copy') as phase:
+                    srchash, dsthash = copy(vid, rec, thisJob, log, db, host, opts)
+                    phase['bytes'] = rec.filesize
 
         except Exception as e:
             log(log.GENERAL|log.FILE, log.INFO, "ERROR during copy",
         			      "Message was: {}".format(e))
-            error_out(vid, thisJob)
+            return error_out(vid, thisJob)
+
+        finally:
+            release_space(rec)
 
         log(log.GENERAL, log.INFO,'Performing copy validation.')
-        if not check_hash(vid, rec, bend):
+        with span(metrics, 'check_hash'):
+            matched = check_hash(vid, bend, srchash, dsthash)
+        if not matched:
             log(log.GENERAL|log.FILE, log.INFO, "ERROR in Hash Check")
-            error_out(vid, thisJob)
+            # the next run copies it all again
+            claim_destination(rec, vid['filename'])
+            return error_out(vid, thisJob)
 
-    # this stuff still makes sense keep
-    if opts.seekdata:
+        # I certainly hope the grabber is working and I do not need to
+        # grab it again. If you have issues or missing data
+        # see fix_metadata.py
         try:
-            for seek in rec.seek:
-                vid.markup.add(seek.mark, seek.offset, seek.type)
+            with span(metrics, 'create'):
+                mdata = rec.exportMetadata()
+                vid.create(dict((column, mdata.get(field))
+                                for field, column in METAFIELDS.items()
+                                if mdata.get(field) is not None))
+                vid.importMetadata(mdata)
+                vid.update()
 
         except Exception as e:
-            log(log.GENERAL|log.FILE, log.INFO, "ERROR in Seek Data", \
-        			      "Message was: {}".format(e.message))
-            error_out(vid, thisJob)
+            log(log.GENERAL|log.FILE, log.INFO, "ERROR creating Video",
+        			      "Message was: {}".format(e))
+            return error_out(vid, thisJob)
+        index_add(vid)
+        drop_checkpoint(rec)
+        metrics['filename'] = vid['filename']
 
-    if opts.skiplist:
+    # this stuff still makes sense keep
+    if opts.seekdata:
         try:
-            copy_markup(vid, rec,
-                        static.MARKUP.MARK_COMM_START,
-                        static.MARKUP.MARK_COMM_END)
+            with span(metrics, 'seekdata') as phase:
+                count = phase['rows'] = copy_seek(vid, rec, db)
+            log(log.GENERAL, log.INFO, 'Seek Data copied',
+                            '{} entries'.format(count))
 
         except Exception as e:
-            log(log.GENERAL|log.FILE, log.INFO, "ERROR in Skip List", \
-        			      "Message was: {}".format(e.message))
-            error_out(vid, thisJob)
+            log(log.GENERAL|log.FILE, log.INFO, "ERROR in Seek Data", \
+        			      "Message was: {}".format(e))
+            return error_out(vid, thisJob)
 
+    # skip and cut lists come over together in one pass
+    types = []
+    if opts.skiplist:
+        types += [static.MARKUP.MARK_COMM_START, static.MARKUP.MARK_COMM_END]
     if opts.cutlist:
+        types += [static.MARKUP.MARK_CUT_START, static.MARKUP.MARK_CUT_END]
+    if types:
         try:
-            copy_markup(vid, rec,
-                        static.MARKUP.MARK_CUT_START,
-                        static.MARKUP.MARK_CUT_END)
+            with span(metrics, 'markup') as phase:
+                count = phase['rows'] = copy_markup(vid, rec, db, types)
+            log(log.GENERAL, log.INFO, 'Skip/Cut List copied',
+                            '{} entries'.format(count))
+
         except Exception as e:
-            log(log.GENERAL|log.FILE, log.INFO, "ERROR in Cut List",
-        			      "Message was: {}".format(e.message))
-            error_out(vid, thisJob)
+            log(log.GENERAL|log.FILE, log.INFO, "ERROR in Skip/Cut List", \
+        			      "Message was: {}".format(e))
+            return error_out(vid, thisJob)
 
     # delete old file if that option is set
     if opts.delete:
         try:
-            rec.delete()
+            with span(metrics, 'delete'):
+                rec.delete()
 
         except Exception as e:
             log(log.GENERAL|log.FILE, log.INFO, "ERROR in Delete Orig",
-        			      "Message was: {}".format(e.message))
-            error_out(vid, thisJob)
+        			      "Message was: {}".format(e))
+            return error_out(vid, thisJob)
     # duh
-    thisJob.setStatus(Job.FINISHED)
+    if thisJob:
+        thisJob.setStatus(Job.FINISHED)
+    return 'migrated'
 
 if __name__ == "__main__":
     main()
@@ -17,7 +17,7 @@ from MythTV import MythDB, Job, Recorded, Video, VideoGrabber,\
                    MythLog, static, MythBE    
 from optparse import OptionParser, OptionGroup
 
-import sys, time
+import sys, os, time, sqlite3, pickle
 
 # Global Constants
 
@@ -40,6 +40,11 @@ MVFMT = 'Movies/%TITLE%'
 #    %STORAGEGROUP%:  storage group containing recorded show
 #    %GENRE%:         first genre listed for recording
 
+# Grabber answers are kept in GRABCACHE for GRABTTL seconds, the least
+# recently used beyond GRABENTRIES are dropped
+GRABCACHE = os.path.expanduser('~/.mythtv/Myth-Rec-to-Vid.grabcache.sqlite')
+GRABTTL = 14*24*3600
+GRABENTRIES = 20000
 
 
 
@@ -189,9 +194,8 @@ class VIDEO:
 #            raise e
         
         if self.type == 'MOVIE':
-            grab = VideoGrabber('Movie')
             try:
-                results = grab.sortedSearch(self.rec.title)
+                results = self.grab_call('Movie', 'sortedSearch', self.rec.title)
                 
             except Exception as e:
                 print (e)
@@ -203,7 +207,7 @@ class VIDEO:
                 for i in results:
                     if i.year == self.rec.getProgram().year and i.title == self.rec.get('title'):
                         self.vid.importMetadata(i)
-                        match = grab.grabInetref(i.get('inetref'))
+                        match = self.grab_call('Movie', 'grabInetref', i.get('inetref'))
                         length = len(match.people)
                         for p in range(length-2):
                             self.vid.cast.add(match.people[p].get('name'))
@@ -211,8 +215,8 @@ class VIDEO:
                         import_info = 'Full MetaData Import complete'
         else:
             try:
-                grab = VideoGrabber('TV')
-                results = grab.sortedSearch(self.rec.title, self.rec.subtitle)
+                results = self.grab_call('TV', 'sortedSearch',
+                                         self.rec.title, self.rec.subtitle)
             except Exception as e:
                 print (e)
                 self.log(MythLog.GENERAL|MythLog.FILE, MythLog.INFO, "ERROR in TV grab", \
@@ -223,8 +227,8 @@ class VIDEO:
                 for i in results:
                     if  i.title == self.rec.get('title') and i.subtitle == self.rec.get('subtitle'):
                         self.vid.importMetadata(i)
-                        match = grab.grabInetref(grab.grabInetref(i.get('inetref'), \
-                                season=i.get('season'),episode=i.get('episode')))
+                        match = self.grab_call('TV', 'grabInetref', i.get('inetref'),
+                                season=i.get('season'),episode=i.get('episode'))
                         length = len(match.people)
                         for p in range(length-2):
                             self.vid.cast.add(match.people[p].get('name'))
@@ -236,6 +240,37 @@ class VIDEO:
 
         self.log(self.log.GENERAL, self.log.INFO, import_info)
 
+    def grab_call(self, kind, method, *args, **kwargs):
+        # Call a VideoGrabber method through the on-disk cache, keyed on the
+        # grabber type, method and arguments. Failures are not cached.
+        key = repr((kind, method, args, sorted(kwargs.items())))
+        now = time.time()
+        os.makedirs(os.path.dirname(GRABCACHE), exist_ok=True)
+        con = sqlite3.connect(GRABCACHE, timeout=30)
+        try:
+            con.execute('CREATE TABLE IF NOT EXISTS grabcache '
+                        '(key TEXT PRIMARY KEY, created REAL, used REAL, value BLOB)')
+            row = con.execute('SELECT value FROM grabcache WHERE key=? AND created>?',
+                              (key, now - GRABTTL)).fetchone()
+            if row:
+                con.execute('UPDATE grabcache SET used=? WHERE key=?', (now, key))
+                con.commit()
+                return pickle.loads(row[0])
+
+            value = getattr(VideoGrabber(kind), method)(*args, **kwargs)
+            try:
+                blob = pickle.dumps(value, 2)
+            except Exception:
+                return value
+            con.execute('INSERT OR REPLACE INTO grabcache VALUES (?,?,?,?)',
+                        (key, now, now, blob))
+            con.execute('DELETE FROM grabcache WHERE key IN (SELECT key FROM grabcache '
+                        'ORDER BY used DESC LIMIT -1 OFFSET ?)', (GRABENTRIES,))
+            con.commit()
+            return value
+        finally:
+            con.close()
+
     def get_type(self):
         if self.rec.programid[:2] == 'MV':
             self.type = 'MOVIE'
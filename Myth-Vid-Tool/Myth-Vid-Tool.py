@@ -21,7 +21,10 @@ __version__= "v1.0"
 from MythTV import MythDB, Video, VideoGrabber, MythBE 
 from optparse import OptionParser, OptionGroup
 
-import sys
+import sys, os, re, struct, json, time, sqlite3, cPickle, threading
+import atexit, cProfile, pstats
+from itertools import groupby, islice
+from multiprocessing.pool import ThreadPool
 
 # Global Constants
 
@@ -44,6 +47,64 @@ MVFMT = 'Movies/%TITLE%'
 #    %STORAGEGROUP%:  storage group containing recorded show
 #    %GENRE%:         first genre listed for recording
 
+# Bytes hashed at each end of the file, see FileHash() in libmythbase
+HASHWINDOW = 2**16
+
+# Grabber answers are kept in GRABCACHE for GRABTTL seconds, the least
+# recently used beyond GRABENTRIES are dropped
+GRABCACHE = os.path.expanduser('~/.mythtv/Myth-Vid-Tool.grabcache.sqlite')
+GRABTTL = 14*24*3600
+GRABENTRIES = 20000
+
+# videometadata rows read per query when walking the library
+PAGESIZE = 500
+
+# Allocation sites printed by --profile memory
+PROFILETOP = 25
+
+# Storage group and Video field for each artwork type
+ARTWORK = {'coverart':('Coverart', 'coverfile'),
+           'screenshot':('Screenshots', 'screenshot'),
+           'banner':('Banners', 'banner'),
+           'fanart':('Fanart', 'fanart'),
+           'trailer':('Trailers', 'trailer')}
+
+
+def profile_start(kinds, parser):
+    # Turn on the collectors named in --profile, their results are written
+    # at exit as Myth-Vid-Tool.<time>.<pid>.prof and .tracemalloc
+    kinds = set(kinds.split(','))
+    if 'all' in kinds:
+        kinds = set(['cpu', 'memory'])
+    if kinds - set(['cpu', 'memory']):
+        parser.error('Unknown --profile kinds: ' + ','.join(sorted(kinds - set(['cpu', 'memory']))))
+    stem = '%s.%s.%d' % (__title__, time.strftime('%Y%m%d%H%M%S'), os.getpid())
+    profiler = None
+    tracing = None
+    if 'cpu' in kinds:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if 'memory' in kinds:
+        try:
+            import tracemalloc
+            tracemalloc.start(PROFILETOP)
+            tracing = tracemalloc
+        except ImportError:
+            print 'No tracemalloc in this Python, --profile memory is ignored'
+
+    def stop():
+        if profiler:
+            profiler.disable()
+            pstats.Stats(profiler).dump_stats(stem + '.prof')
+            print 'CPU profile written to ' + stem + '.prof'
+        if tracing:
+            snapshot = tracing.take_snapshot()
+            tracing.stop()
+            snapshot.dump(stem + '.tracemalloc')
+            for stat in snapshot.statistics('lineno')[:PROFILETOP]:
+                print stat
+            print 'Memory snapshot written to ' + stem + '.tracemalloc'
+    atexit.register(stop)
 
 def main():
     parser = OptionParser(usage="usage: option [option] [option]")
@@ -54,12 +115,26 @@ def main():
             help="checks for duplicate entries in the Video database")
     maintenancegroup.add_option("--check_orphans", action="store_true", default=False, dest="check_orphans",
             help="checks for orphaned DB entries in Video")
+    maintenancegroup.add_option("--delete_orphans", action="store_true", default=False, dest="delete_orphans",
+            help="with --check_orphans, deletes the DB entries that have no file")
+    maintenancegroup.add_option("--import_orphans", action="store_true", default=False, dest="import_orphans",
+            help="with --check_orphans, has the backend scan in the files that have no DB entry")
+    maintenancegroup.add_option("--hashdedup", action="store_true", default=False, dest="hashdedup",
+            help="checks for entries with identical file content, hashing files that have no hash yet")
     parser.add_option_group(maintenancegroup)
    
     actiongroup = OptionGroup(parser, "Meta Updates",
                     "This option updates Video Meta Data")
     actiongroup.add_option('--update', action='store_true', default=False, dest='update',
             help='Updates the video meta data on each entry')
+    actiongroup.add_option('--parallel', action='store_true', default=False, dest='parallel',
+            help='With --update, runs --workers grabber lookups at a time without asking, \
+                  videos with several matches are saved to the review file')
+    actiongroup.add_option('--review', action='store_true', default=False, dest='review',
+            help='With --update, asks about the videos saved to the review file')
+    actiongroup.add_option('--reviewfile', action='store', type='string',
+            default='Myth-Vid-Tool.review', dest='reviewfile',
+            help='Review file for --parallel and --review, default Myth-Vid-Tool.review')
     parser.add_option_group(actiongroup)
     
     othergroup = OptionGroup(parser, 'Other Options',
@@ -71,11 +146,24 @@ def main():
     othergroup.add_option('--step', action="store_true", default=False, dest='step',
                           help='Steps through each action to allow evaluation of \
                                   process')
+    othergroup.add_option('--workers', action='store', type='int', default=4, dest='workers',
+                          help='Number of files hashed or grabber lookups run at the same \
+                                  time, default 4')
+    othergroup.add_option('--profile', action='store', type='string', dest='profile',
+                          help='Profiles the run, a comma separated list of cpu (cProfile, \
+                                  a .prof file for snakeviz, main thread only) and memory \
+                                  (a tracemalloc snapshot, Python 3 only). Written to the \
+                                  current directory')
     parser.add_option_group(othergroup)
     
 
     
     opts, args = parser.parse_args()
+    if opts.hashdedup:
+        opts.dedup = True
+
+    if opts.profile:
+        profile_start(opts.profile, parser)
 
 
  
@@ -86,132 +174,180 @@ def main():
     # setup the connection to the DB
     db = MythDB()
     be = MythBE()
-    
-    #Setup a scanner for all videos in the DB
-    videos = db.searchVideos()
-    # setup a Video object to work with    
-    
-    def get_Meta(item):
-        
-        metadata = item.exportMetadata()
 
-        if not item.filename.startswith('Television'):
-            grab = VideoGrabber('Movie')
-            if item.get('inetref') != '00000000':
-                try:
-                    match = grab.grabInetref(item.inetref)
-                    item.importMetadata(match)
-                    item.plot = match.get('description')
-                    item.title = match.get('title')
-                    copy_Art(match, item)
-                    item.update()
-                    return
-
-                except Exception:
-                    print 'grabber failed for: ' + str(item.get('inetref'))
-                    print 'trying by name instead'
-
-            try:            
-                results = grab.sortedSearch(item.title)
+    def folder_clause(folder):
+        # SQL condition and arguments limiting filename to a folder prefix
+        if not folder:
+            return '1=1', []
+        prefix = re.sub(r'([\\%_])', r'\\\1', folder)
+        return 'filename LIKE %s', [prefix + '%']
+
+    def stream_videos(folder=None):
+        # Yield the Video entries under folder a page at a time, each page
+        # picking up after the last intid seen so memory stays flat
+        where, args = folder_clause(folder)
+        last = -1
+        while True:
+            with db as cursor:
+                cursor.execute('SELECT * FROM videometadata WHERE intid > %s AND '
+                               + where + ' ORDER BY intid LIMIT %s',
+                               [last] + args + [PAGESIZE])
+                rows = cursor.fetchall()
+            for row in rows:
+                item = Video.fromRaw(row, db=db)
+                last = item.intid
+                yield item
+            if len(rows) < PAGESIZE:
+                return
+
+    grabbers = {}
+
+    def grab_call(kind, method, *args, **kwargs):
+        # Call a VideoGrabber method through the on-disk cache. Answers are
+        # keyed on the grabber type, method and arguments, failures are not
+        # cached. A connection per call keeps this usable from workers.
+        key = repr((kind, method, args, sorted(kwargs.items())))
+        now = time.time()
+        if not os.path.isdir(os.path.dirname(GRABCACHE)):
+            os.makedirs(os.path.dirname(GRABCACHE))
+        con = sqlite3.connect(GRABCACHE, timeout=30)
+        try:
+            con.execute('CREATE TABLE IF NOT EXISTS grabcache '
+                        '(key TEXT PRIMARY KEY, created REAL, used REAL, value BLOB)')
+            row = con.execute('SELECT value FROM grabcache WHERE key=? AND created>?',
+                              (key, now - GRABTTL)).fetchone()
+            if row:
+                con.execute('UPDATE grabcache SET used=? WHERE key=?', (now, key))
+                con.commit()
+                return cPickle.loads(str(row[0]))
+
+            if kind not in grabbers:
+                grabbers[kind] = VideoGrabber(kind)
+            value = getattr(grabbers[kind], method)(*args, **kwargs)
+            try:
+                blob = sqlite3.Binary(cPickle.dumps(value, 2))
+            except Exception:
+                return value
+            con.execute('INSERT OR REPLACE INTO grabcache VALUES (?,?,?,?)',
+                        (key, now, now, blob))
+            con.execute('DELETE FROM grabcache WHERE key IN (SELECT key FROM grabcache '
+                        'ORDER BY used DESC LIMIT -1 OFFSET ?)', (GRABENTRIES,))
+            con.commit()
+            return value
+        finally:
+            con.close()
+
+    def grabber_for(item):
+        if item.filename.startswith('Television'):
+            return 'TV'
+        return 'Movie'
+
+    def episode_of(item):
+        # season and episode to look up, when the video has both
+        if item.filename.startswith('Television') and item.season and item.episode:
+            return {'season':item.season, 'episode':item.episode}
+        return {}
+
+    # the series picked for a TV title in this run, so the other episodes
+    # of an ambiguous title are not asked about again
+    series = {}
+
+    def series_key(item):
+        if episode_of(item):
+            return (grabber_for(item), item.title)
+        return None
+
+    def remember(item, listing):
+        key = series_key(item)
+        if key is not None:
+            series[key] = listing
+
+    def fetch(item, listing):
+        try:
+            return 'match', grab_call(grabber_for(item), 'grabInetref',
+                                      listing.get('inetref'), **episode_of(item))
+        except Exception, e:
+            return 'error', str(e)
+
+    def lookup(item):
+        # Ask the grabber about item without prompting or writing anything.
+        # Returns ('match', metadata), ('choose', search results),
+        # ('none', None) or ('error', message)
+        # An episode with a known season and episode is found through its
+        # series, so every episode of a show shares one cached search
+        kind = grabber_for(item)
+        tv = kind == 'TV'
+        if series_key(item) in series:
+            return fetch(item, series[series_key(item)])
+        if not tv and item.get('inetref') != '00000000':
+            try:
+                return 'match', grab_call(kind, 'grabInetref', item.inetref)
+            except Exception:
+                print 'grabber failed for: ' + str(item.get('inetref'))
+                print 'trying by name instead'
+        try:
+            if tv and not episode_of(item):
+                results = grab_call(kind, 'sortedSearch', item.title, item.subtitle)
+            else:
+                results = grab_call(kind, 'sortedSearch', item.title)
+        except Exception, e:
+            return 'error', str(e)
+
+        if len(results) == 0:
+            return 'none', None
+        elif len(results) > 1:
+            return 'choose', results
+        return fetch(item, results[0])
+
+    def choose(item, results):
+        # let the user pick one of several search results, None to skip
+        menu = {}
+        list = 1
+        for each in results:
+            label = each.get('title')
+            if each.get('subtitle'):
+                label = label + ' - ' + each.get('subtitle')
+            menu[list]= label + ', year: ' + str(each.get('year')) \
+                              + ', inetref: ' + str(each.get('inetref'))
+            list = list + 1
+        menu[list]='Skip to next video\n\n'
+        print '\n'
+        while True: 
+            options=menu.keys()
+            options.sort()
+            for entry in options: 
+                print entry, menu[entry]
+            try:
+                selection=input("Please Select: ") 
+                if selection in range (1,len(results)+1): 
+                    return results[selection -1]
+                elif selection == len(results)+1:
+                    return None
+                else: 
+                  print "Invalid Selection, try again!\n\n" 
+            except Exception:
+                  print "Invalid Selection, try again!\n\n" 
+
+    def finish_Meta(item, metadata, kind, data):
+        # apply the outcome of lookup() to item
+        if kind == 'match':
+            try:
+                item.importMetadata(data)
+                item.plot = data.get('description')
+                item.title = data.get('title')
+                copy_Art(data, item)
+                item.update()
+                print 'Full MetaData Import complete for: ' + item.title + '\n'
+
             except Exception, e:
                 print 'grabber failed for: ' + str(item.get('inetref'))
                 print e
-                return
-                    
-            if len(results) > 0:
-                if len(results) > 1:
-                    menu = {}
-                    list = 1
-                    for each in results:
-                        menu[list]= each.title + ', year: ' + str(each.get('year')) \
-                                                + ', inetref: ' + str(each.get('inetref'))
-                        list = list + 1
-                    menu[list]='Skip to next video\n\n'
-                    print '\n'
-                    while True: 
-                        options=menu.keys()
-                        options.sort()
-                        for entry in options: 
-                            print entry, menu[entry]
-                        try:
-                            selection=input("Please Select: ") 
-                            if selection in range (1,len(results)+1): 
-                                listing = results[selection -1]
-                                break
-                            elif selection == len(results)+1:
-                                return
-                            else: 
-                              print "Invalid Selection, try again!\n\n" 
-                        except Exception:
-                              print "Invalid Selection, try again!\n\n" 
-                else:
-                    listing = results[0]
-                
-                try:
-                    match = grab.grabInetref(listing.get('inetref'))
-                    item.importMetadata(match)
-                    item.plot = match.get('description')
-                    item.title = match.get('title')
-                    copy_Art(match, item)
-                    item.update()
-                    print 'Full MetaData Import complete for: ' + item.title + '\n'
-
-                except Exception, e:
-                    print 'grabber failed for: ' + str(item.get('inetref'))
-                    print e
-                
- 
-            elif len(results) == 0:
-                print 'No MetaData to import for: ' + item.title + '\n'
-        else:
-            grab = VideoGrabber('TV')
-            results = grab.sortedSearch(item.title, item.subtitle)
-            if len(results) > 0:
-                if len(results) > 1:
-                    menu = {}
-                    list = 1
-                    for each in results:
-                        menu[list]= each.title + ' - ' + each.subtitle, \
-                                        + ' year: ' + str(each.get('year')) \
-                                        + ', inetref: ' + str(each.get('inetref'))
-                        list = list + 1
-                    menu[list]='Skip to next video\n\n'
-                    while True: 
-                        options=menu.keys()
-                        options.sort()
-                        for entry in options: 
-                            print entry, menu[entry]
-                        try:
-                            selection=input("Please Select:") 
-                            if selection in range (1,len(results)+1): 
-                                listing = results[selection -1]
-                                break
-                            elif selection == len(results)+1:
-                                return
-                            else: 
-                              print "Invalid Selection, try again!\n\n" 
-                        except Exception:
-                              print "Invalid Selection, try again!\n\n" 
-                              
-                else:
-                    listing = results[0]
-                    
-                try:
-                    match = grab.grabInetref(listing.get('inetref'))
-                    item.importMetadata(match)
-                    item.plot = match.get('description')
-                    item.title = match.get('title')
-                    copy_Art(match, item)
-                    item.update()
-                    print 'Full MetaData Import complete for: ' + item.title
-                    
-                except Exception, e:
-                    print 'grabber failed for: ' + str(item.get('inetref'))
-                    print e
-                
-
-            elif len(results) == 0:
-                print 'No MetaData to import for: ' + item.title
+        elif kind == 'none':
+            print 'No MetaData to import for: ' + item.title + '\n'
+        elif kind == 'error':
+            print 'grabber failed for: ' + str(item.get('inetref'))
+            print data
+            return
 
         try:
             item.category = metadata.get('category')
@@ -219,41 +355,350 @@ def main():
         except Exception, e:
             print 'grabber failed for: ' + str(item.get('inetref'))
             print e
-            
+
+    def get_Meta(item):
+        metadata = item.exportMetadata()
+        kind, data = lookup(item)
+        if kind == 'choose':
+            listing = choose(item, data)
+            if listing is None:
+                return
+            remember(item, listing)
+            kind, data = fetch(item, listing)
+        finish_Meta(item, metadata, kind, data)
+
+    def update_parallel(items):
+        # Run the grabber lookups on a pool of workers and apply each result
+        # here as it arrives. Searches with several results are written to
+        # the review file for a later --review instead of asking now. The
+        # pool gets PAGESIZE items at a time, as it would otherwise read the
+        # whole of items up front.
+        def work(item):
+            return item, item.exportMetadata(), lookup(item)
+
+        review = open(opts.reviewfile, 'a')
+        pool = ThreadPool(opts.workers)
+        deferred = 0
+        items = iter(items)
+        try:
+            while True:
+                page = list(islice(items, PAGESIZE))
+                if not page:
+                    break
+                for item, metadata, (kind, data) in pool.imap_unordered(work, page):
+                    print item.title
+                    if kind == 'choose':
+                        choices = [dict((field, each.get(field)) for field in
+                                        ('title', 'subtitle', 'year', 'inetref'))
+                                   for each in data]
+                        review.write(json.dumps({'intid':item.intid,
+                                                 'choices':choices}) + '\n')
+                        deferred += 1
+                        print 'Several matches, deferred to ' + opts.reviewfile + '\n'
+                    else:
+                        finish_Meta(item, metadata, kind, data)
+        finally:
+            pool.close()
+            review.close()
+        print '%d videos deferred for review' % deferred
+
+    def update_review():
+        # walk the videos deferred by update_parallel() and ask for each
+        entries = [json.loads(line) for line in open(opts.reviewfile) if line.strip()]
+        for entry in entries:
+            item = Video(entry['intid'], db=db)
+            print item.title
+            listing = series.get(series_key(item))
+            if listing is None:
+                listing = choose(item, entry['choices'])
+                if listing is None:
+                    continue
+                remember(item, listing)
+            kind, data = fetch(item, listing)
+            finish_Meta(item, item.exportMetadata(), kind, data)
+        os.remove(opts.reviewfile)
+
+    # artwork state for the whole run, see copy_Art()
+    art = {'groups':{}, 'urls':set(), 'pool':None, 'count':0,
+           'lock':threading.Lock()}
+
+    def download(url, group, filename):
+        try:
+            be.downloadTo(url, group, filename)
+        except Exception, e:
+            print 'artwork download failed for: ' + url
+            print e
+
     def copy_Art(meta, item):
+        # The item points at its art straight away, the downloads run on a
+        # pool of workers. Art already in its storage group, or already
+        # fetched by this run for another video, is not downloaded again.
         select = {}
         for images in meta.images:
             if images.type not in select:
                 select[images.type] = images
 
         for key in select:
-            be.downloadTo(select[key]['url'], select[key]['type'], select[key]['filename'])
-            if images.type == 'coverart':
-                item.coverfile = images.filename
-            elif images.type == 'screenshot':
-                item.screenshot = images.filename
-            elif images.type == 'banner':
-                item.banner = images.filename
-            elif images.type == 'fanart':
-                item.fanart = images.filename
-            elif images.type == 'trailer':
-                item.trailer = images.filename
-            
+            if key not in ARTWORK:
+                continue
+            group, field = ARTWORK[key]
+            url = select[key]['url']
+            filename = select[key]['filename']
+            with art['lock']:
+                if group not in art['groups']:
+                    art['groups'][group] = list_storage(group)[0]
+                fresh = url not in art['urls'] and filename not in art['groups'][group]
+                art['urls'].add(url)
+                art['groups'][group].add(filename)
+                if fresh:
+                    if art['pool'] is None:
+                        art['pool'] = ThreadPool(opts.workers)
+                    art['pool'].apply_async(download, (url, group, filename))
+                    art['count'] += 1
+            setattr(item, field, filename)
+
+    def finish_Art():
+        # wait for the artwork downloads still queued
+        if art['pool'] is not None:
+            art['pool'].close()
+            art['pool'].join()
+        print '%d artwork files downloaded' % art['count']
+
     #define a function to dedup the DB upon detection
     def del_dup(dup_item):
         vid = dup_item
         print 'Deleting duplicate entry for: ' + vid.title
         vid.delete()
-    def deduplicate_DB(item,x):
-        # try to determine if one of the items has more metadata
-        # to retain than the other
-        # otherwise delete the last entry in the DB
-        if x.inetref > 0 and item.inetref == 0:
-            del_dup(item)
-        elif x.inetref == 0 and item.inetref > 0 :
-            del_dup(x)
-        else:
-            del_dup(item)
+
+    def load_columns(fields, folder=None):
+        # read the library, or the folder of it, in one query, one list per
+        # column
+        where, args = folder_clause(folder)
+        with db as cursor:
+            cursor.execute('SELECT ' + ', '.join(fields) + ' FROM videometadata WHERE '
+                           + where, args)
+            rows = cursor.fetchall()
+        if not rows:
+            return dict((field, []) for field in fields)
+        return dict(zip(fields, [list(col) for col in zip(*rows)]))
+
+    def normalize(text):
+        # letters and digits of any script, without case
+        text = text or u''
+        if isinstance(text, str):
+            text = text.decode('utf-8', 'replace')
+        return re.sub(r'(?u)[\W_]+', u'', text.lower())
+
+    def has_ref(inetref):
+        return inetref not in (None, '', '00000000')
+
+    def same_content(cols, i, j):
+        return bool(cols['hash'][i]) and cols['hash'][i] != 'NULL' \
+               and cols['hash'][i] == cols['hash'][j] \
+               and cols['filesize'][i] == cols['filesize'][j]
+
+    def dedup_plan(cols):
+        # Sort the rows once on title, subtitle, season and episode and walk
+        # the runs of equal keys. In each run the row with an inetref, else
+        # the oldest, is kept. Rows with the same file name are deleted,
+        # rows with other files, even of the same content, are left for
+        # review as deleting them would leave their file to be scanned in
+        # again.
+        keys = [(normalize(title), normalize(subtitle), season or 0, episode or 0)
+                for title, subtitle, season, episode in
+                zip(cols['title'], cols['subtitle'], cols['season'], cols['episode'])]
+        rows = sorted(xrange(len(keys)), key=keys.__getitem__)
+
+        delete = []
+        review = []
+        for key, run in groupby(rows, key=keys.__getitem__):
+            run = list(run)
+            if len(run) < 2:
+                continue
+            keep = min(run, key=lambda i: (not has_ref(cols['inetref'][i]),
+                                           cols['intid'][i]))
+            for i in run:
+                if i == keep:
+                    continue
+                elif cols['filename'][i] == cols['filename'][keep]:
+                    delete.append((i, keep))
+                else:
+                    review.append((i, keep))
+        return delete, review
+
+    def file_hash(path):
+        # same value as MythBE.getHash(), size plus the little endian 64 bit
+        # words of the first and last 64 KiB
+        size = os.path.getsize(path)
+        if not size:
+            return 'NULL', size
+        total = size
+        fp = open(path, 'rb')
+        try:
+            for offset in (0, max(size - HASHWINDOW, 0)):
+                fp.seek(offset)
+                data = fp.read(HASHWINDOW)
+                words = len(data)//8
+                total += sum(struct.unpack('<%dQ' % words, data[:words*8]))
+        finally:
+            fp.close()
+        return '%x' % (total & 0xFFFFFFFFFFFFFFFF), size
+
+    def fill_hashes(cols):
+        # Hash the rows that have none, from the local disk when the Videos
+        # group is here and through the backend otherwise, on a pool of
+        # workers. The results are stored back in videometadata.
+        here = db.gethostname()
+        dirs = [sg.dirname for sg in db.getStorageGroup(groupname='Videos',
+                                                       hostname=here)
+                           if os.path.isdir(sg.dirname)]
+
+        def work(i):
+            filename = cols['filename'][i]
+            if cols['host'][i] == here:
+                for dirname in dirs:
+                    path = os.path.join(dirname, filename)
+                    if os.path.exists(path):
+                        return (i,) + file_hash(path)
+            return i, be.getHash(filename, 'Videos', cols['host'][i]), None
+
+        missing = [i for i in xrange(len(cols['intid'])) if not cols['hash'][i]]
+        pool = ThreadPool(opts.workers)
+        try:
+            results = pool.map(work, missing)
+        finally:
+            pool.close()
+
+        sized = []
+        unsized = []
+        for i, filehash, size in results:
+            if not filehash or filehash == 'NULL':
+                continue
+            cols['hash'][i] = filehash
+            if size is None:
+                unsized.append((filehash, cols['intid'][i]))
+            else:
+                cols['filesize'][i] = size
+                sized.append((filehash, size, cols['intid'][i]))
+        with db as cursor:
+            cursor.executemany('UPDATE videometadata SET hash=%s, filesize=%s WHERE intid=%s', sized)
+            cursor.executemany('UPDATE videometadata SET hash=%s WHERE intid=%s', unsized)
+        print '%d of %d missing hashes filled in' % (len(sized) + len(unsized), len(missing))
+
+    def hash_plan(cols):
+        # Cluster the rows on hash and size. As in dedup_plan() the row with
+        # an inetref, else the oldest, is kept, extra rows for the same file
+        # are deleted and copies under other names are left for review.
+        rows = [i for i in xrange(len(cols['intid']))
+                if cols['hash'][i] and cols['hash'][i] != 'NULL']
+        key = lambda i: (cols['hash'][i], cols['filesize'][i])
+        rows.sort(key=key)
+
+        delete = []
+        review = []
+        for content, run in groupby(rows, key=key):
+            run = list(run)
+            if len(run) < 2:
+                continue
+            keep = min(run, key=lambda i: (not has_ref(cols['inetref'][i]),
+                                           cols['intid'][i]))
+            for i in run:
+                if i == keep:
+                    continue
+                elif cols['filename'][i] == cols['filename'][keep]:
+                    delete.append((i, keep))
+                else:
+                    review.append((i, keep))
+        return delete, review
+
+    def list_storage(group):
+        # Every file in a storage group, as paths relative to the group, the
+        # hosts whose every directory of the group was listed and those that
+        # could not be. Directories on this machine are walked here, those
+        # on other hosts through the backend.
+        here = db.gethostname()
+        files = set()
+        hosts = set()
+        failed = set()
+        for sg in db.getStorageGroup(groupname=group):
+            hosts.add(sg.hostname)
+            if sg.hostname == here:
+                if not os.path.isdir(sg.dirname):
+                    failed.add(here)
+                    continue
+                base = len(sg.dirname.rstrip('/')) + 1
+                for dirpath, dirnames, filenames in os.walk(sg.dirname):
+                    for name in filenames:
+                        files.add(os.path.join(dirpath, name)[base:])
+            elif not list_remote(sg.hostname, group, sg.dirname, files):
+                failed.add(sg.hostname)
+        return files, hosts - failed, failed
+
+    def list_remote(host, group, dirname, files):
+        # Walk a storage group directory of another host, one file list
+        # request per directory as the backend does not recurse. False when
+        # the host is unreachable or the group directory lists as empty,
+        # which most likely means it is not mounted.
+        base = dirname.rstrip('/') + '/'
+        pending = ['']
+        while pending:
+            sub = pending.pop()
+            listing = be.getSGList(host, group, base + sub)
+            if listing == -1 and sub:
+                continue
+            if not isinstance(listing, tuple):
+                return False
+            dirs, names, sizes = listing
+            pending.extend(sub + name + '/' for name in dirs)
+            files.update(sub + name for name in names)
+        return True
+
+    def orphans(folder=None):
+        # Compare the storage listing with every videometadata filename.
+        # Returns the DB rows without a file, the files without a row, the
+        # rows that could not be checked and the hosts that could not be
+        # listed. A row is only checked when its host was listed, rows of a
+        # host without a Videos group, or with no host, are not. An absolute
+        # filename is checked on this machine. Only files with a videotypes
+        # extension count as missing a row.
+        with db as cursor:
+            cursor.execute('SELECT extension FROM videotypes WHERE f_ignore=0')
+            extensions = set(ext.lower() for (ext,) in cursor.fetchall())
+            where, args = folder_clause(folder)
+            cursor.execute('SELECT intid, filename, host FROM videometadata WHERE '
+                           + where, args)
+            rows = cursor.fetchall()
+        here = db.gethostname()
+        files, listed, failed = list_storage('Videos')
+        known = set(filename for intid, filename, host in rows)
+        nofile = []
+        unchecked = []
+        for intid, filename, host in rows:
+            absolute = filename.startswith('/')
+            if filename in files or (absolute and os.path.exists(filename)):
+                continue
+            elif (host == here) if absolute else (host in listed):
+                nofile.append((intid, filename))
+            else:
+                unchecked.append((intid, filename, host))
+        norow = set(name for name in files - known
+                    if os.path.splitext(name)[1][1:].lower() in extensions)
+        if folder:
+            norow = set(name for name in norow if name.startswith(folder))
+        return nofile, sorted(norow), unchecked, sorted(failed)
+
+    def delete_rows(intids):
+        # remove the entries and what hangs off them, a single statement each
+        if not intids:
+            return
+        marks = ','.join(['%s']*len(intids))
+        with db as cursor:
+            for table in ('videometadatacast', 'videometadatagenre',
+                          'videometadatacountry'):
+                cursor.execute('DELETE FROM %s WHERE idvideo IN (%s)' % (table, marks),
+                               intids)
+            cursor.execute('DELETE FROM videometadata WHERE intid IN (%s)' % marks,
+                           intids)
 
     def Step(title):
         menu = {}
@@ -278,72 +723,76 @@ def main():
               print "Invalid Selection, try again!\n\n" 
         
     if opts.dedup and not opts.update and not opts.check_orphans:
-        # Build a dictionary to store all searched videos
-        check = {}
+        cols = load_columns(['intid', 'title', 'subtitle', 'season', 'episode',
+                             'filename', 'hash', 'inetref', 'filesize', 'host'],
+                            opts.folder)
+        if opts.hashdedup:
+            fill_hashes(cols)
+            delete, review = hash_plan(cols)
+        else:
+            delete, review = dedup_plan(cols)
+
+        for i, keep in review:
+            print 'Unable to determine desired operation for:'
+            print cols['title'][i]
+            if same_content(cols, i, keep):
+                print 'The same content is stored under different file names'
+            else:
+                print 'The duplicate entries have different file names'
+            print cols['filename'][i]
+            print cols['filename'][keep]
 
-        # loop through the videos
-        for item in videos:
+        deleted = 0
+        for i, keep in delete:
             if opts.step:
-                if Step(item.title):
+                if Step(cols['title'][i]):
                     continue
-                
-            if opts.folder:
-                if item.title in check and item.filename.startswith(opts.folder):
-                    x = check.get(item.title)
-                    if item.filename == x.filename:
-                        deduplicate_DB(item,x)
-                        continue
-                    else:                            
-                        print 'Unable to determine desired operation for:'
-                        print item.title
-                        print 'The duplicate entries have different file names'
-                        print item.filename
-                        print x.filename
-                        continue
-                    
-                else:
-                    check[item.title] = item
-            else:
-                if item.title in check:
-                    x = check.get(item.title)
-                    if item.filename == x.filename:
-                        deduplicate_DB(item,x)
-                        continue
-                    else:                            
-                        print 'Unable to determine desired operation for:'
-                        print item.title
-                        print 'The duplicate entries have different file names'
-                        print item.filename
-                        print x.filename
-                        continue
-                    
-                else:
-                    check[item.title] = item
+            del_dup(Video(cols['intid'][i], db=db))
+            deleted += 1
+
+        print '%d duplicates deleted, %d left for review' % (deleted, len(review))
         sys.exit(0)
 
     elif not opts.dedup and opts.update and not opts.check_orphans:
-        for item in db.searchVideos():
+        if opts.review:
+            update_review()
+            finish_Art()
+            sys.exit(0)
+        if opts.parallel:
+            update_parallel(stream_videos(opts.folder))
+            finish_Art()
+            sys.exit(0)
+
+        for item in stream_videos(opts.folder):
             if opts.step:
-                if opts.folder:
-                    if opts.folder == item.filename[:len(opts.folder)]:
-                        if Step(item.title):
-                            continue
-                            
-                elif Step(item.title):
+                if Step(item.title):
                     continue
-            if opts.folder:
-                if opts.folder == item.filename[:len(opts.folder)]:
-                    print item.title
-                    get_Meta(item)
-            else:
-                print item.title
-                get_Meta(item)
+            print item.title
+            get_Meta(item)
+        finish_Art()
         sys.exit(0)
         
     elif not opts.dedup and not opts.update and opts.check_orphans:
-        #if opts.step:
-        #    if Step(item.title):
-        #        continue
+        nofile, norow, unchecked, failed = orphans(opts.folder)
+        for host in failed:
+            print 'Unable to list the Videos group on %s, its DB entries were not checked' % host
+        for intid, filename, host in unchecked:
+            print 'Not checked, DB entry %d on host %s: %s' % (intid, host or '(none)', filename)
+        for intid, filename in nofile:
+            print 'No file for DB entry %d: %s' % (intid, filename)
+        for filename in norow:
+            print 'No DB entry for file: ' + filename
+        print '%d DB entries without a file, %d files without a DB entry, %d DB entries not checked' \
+                % (len(nofile), len(norow), len(unchecked))
+
+        if opts.delete_orphans and nofile:
+            if not opts.step or not Step('delete %d DB entries' % len(nofile)):
+                delete_rows([intid for intid, filename in nofile])
+                print 'Deleted %d DB entries' % len(nofile)
+        if opts.import_orphans and norow:
+            if not opts.step or not Step('import %d files' % len(norow)):
+                be.scanVideos()
+                print 'Backend video scan requested'
         sys.exit(0)
 
     elif len(args) == 0:
@@ -7,16 +7,13 @@ Created on Sat Oct 10 02:48:03 2020
 """
 
 
-from MythTV import MythDB, Job, Recorded, Video, VideoGrabber,\
-                   MythLog, static, MythBE    
-from optparse import OptionParser, OptionGroup
+import os, sys, subprocess
 
-import sys, time
+# Myth-Backlog does the query, the check for jobs already queued and the
+# batched inserts, this only names the recordings
+BACKLOG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'Myth-Backlog', 'Myth-Backlog.py')
 
-db = MythDB()
-    
-xxx = Recorded.getAllEntries()
-for i in xxx:
-    if i.title == 'The Three Stooges' and i.season == 0:
-        thisrec = i
-        Job.fromRecorded(thisrec,4,args='/dev/null')
+sys.exit(subprocess.call(['python3', BACKLOG, '--job', 'metadata',
+                          '--args', '/dev/null',
+                          'title=The Three Stooges', 'season=0']))